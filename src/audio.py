@@ -1,40 +1,136 @@
+import json
+import logging
+import os
+import select
+import threading
+
 import alsaaudio
+import xdg
+
+class AudioController:
+    # microphone mute through an ALSA capture mixer; the capture switch is followed through the
+    # mixer's poll descriptors on a background thread, so changes made elsewhere (alsamixer, a
+    # headset button) reach the listeners at once and is_capturing() never touches the hardware
+    preferred_mixer = 'Capture'
 
-class Audio:
     def __init__(self):
-        self.recording_mixer = self.get_default_mixer()
-        self.should_capture = False
+        self._mutex = threading.Lock() # the mixer is used from both the caller and the event thread
+        self._state_mutex = threading.Lock()
+        self._listeners = []
+        self._thread = None
+        self._wake_r, self._wake_w = None, None
 
-    def set_capture(self, rec = True):
-        if self.recording_mixer:
-            self.recording_mixer.setrec(rec)
-        self.should_capture = rec
+        self.recording_mixer = self.get_default_mixer()
+        self._capturing = self._read_capture()
+        self.should_capture = False # follows the mixer once set_capture has been called or it changes
 
-    def is_capturing(self):
-        if self.recording_mixer:
-            return self.recording_mixer.getrec()[0] != 0
-        else:
-            return False
+    @staticmethod
+    def get_cache_path():
+        return xdg.XDG_CACHE_HOME / 'mmhZoom' / 'audio.json'
 
     @staticmethod
     def test_mixer(name):
-        mixer = alsaaudio.Mixer(name)
         try:
+            mixer = alsaaudio.Mixer(name)
             mixer.getrec()
             return mixer
-        except:
+        except alsaaudio.ALSAAudioError:
             return
 
     def get_recording_mixers(self):
+        # probes every control of the default card, slow on cards with many controls
         all_mixers = alsaaudio.mixers()
-        mixers = [(name, Audio.test_mixer(name)) for name in all_mixers]
+        mixers = [(name, AudioController.test_mixer(name)) for name in all_mixers]
         mixers = [(name, mixer) for name, mixer in mixers if mixer]
         return dict(mixers)
 
     def get_default_mixer(self):
-        mixers = self.get_recording_mixers()
-        m = mixers.get('Capture')
-        if m is not None: return m
+        # the mixer found last time is tried first, then the usual name, and only then every control
+        cache_path = AudioController.get_cache_path()
         try:
-            return next(iter(mixers.values()))
-        except StopIteration: pass
+            with open(cache_path) as f:
+                cached_name = json.load(f)['mixer']
+        except (OSError, ValueError, KeyError):
+            cached_name = None
+
+        for name in (cached_name, self.preferred_mixer):
+            mixer = name and AudioController.test_mixer(name)
+            if mixer:
+                break
+        else:
+            mixers = self.get_recording_mixers()
+            name, mixer = next(iter(mixers.items()), (None, None))
+
+        if name is not None and name != cached_name:
+            try:
+                cache_path.parent.mkdir(parents = True, exist_ok = True)
+                with open(cache_path, "w") as f:
+                    json.dump({'mixer': name}, f)
+            except OSError as e:
+                logging.info("Cannot cache mixer name: %s" % e)
+        return mixer
+
+    def _read_capture(self):
+        if self.recording_mixer:
+            with self._mutex:
+                return self.recording_mixer.getrec()[0] != 0
+        return False
+
+    def add_listener(self, callback):
+        # callback(capturing: bool) runs on the event thread whenever the capture switch changes
+        self._listeners.append(callback)
+        self.start()
+
+    def start(self):
+        if self._thread is not None or not self.recording_mixer:
+            return
+        self._wake_r, self._wake_w = os.pipe()
+        self._thread = threading.Thread(target = self._run, daemon = True)
+        self._thread.start()
+
+    def _run(self):
+        poller = select.poll()
+        with self._mutex:
+            descriptors = self.recording_mixer.polldescriptors()
+        for fd, mask in descriptors:
+            poller.register(fd, mask)
+        poller.register(self._wake_r, select.POLLIN)
+
+        while True:
+            events = poller.poll()
+            if any(fd == self._wake_r for fd, mask in events):
+                return
+            with self._mutex:
+                self.recording_mixer.handleevents()
+                capturing = self.recording_mixer.getrec()[0] != 0
+            self._set_state(capturing)
+
+    def _set_state(self, capturing: bool):
+        with self._state_mutex:
+            if capturing == self._capturing:
+                return
+            self._capturing = capturing
+            self.should_capture = capturing
+        for callback in self._listeners:
+            callback(capturing)
+
+    def set_capture(self, rec = True):
+        if self.recording_mixer:
+            with self._mutex:
+                self.recording_mixer.setrec(rec)
+        self._set_state(rec)
+        self.should_capture = rec
+
+    def is_capturing(self):
+        return self._capturing
+
+    def close(self):
+        if self._thread is not None:
+            os.write(self._wake_w, b'x')
+            self._thread.join()
+            self._thread = None
+            os.close(self._wake_r)
+            os.close(self._wake_w)
+
+    def __repr__(self):
+        return "AudioController<%s>" % ("capturing" if self._capturing else "muted")
@@ -0,0 +1,275 @@
+import logging
+import threading
+import time
+
+import alsaaudio
+import numpy as np
+
+from metrics import metrics
+
+# room audio recorded alongside the video loop buffer and played with the loop, so looping does not go
+# silent; the meeting app takes its microphone from the other end of a loopback sound device, e.g.
+#   sudo modprobe snd-aloop
+# and AudioLoop(playback_device = 'hw:Loopback,0') while the meeting app records from hw:Loopback,1
+
+class LoopAudio:
+    # the samples of one loop sequence and the playback position in it; set_sequence() swaps in a new
+    # one as a whole, so the playback thread never sees a position from another sequence
+    def __init__(self, starts: np.ndarray, blends: np.ndarray, n_blends: int, frame_samples: int):
+        self.starts = starts # ring position of each entry after the blends, -1 when missing
+        self.blends = blends # samples of the blended entries, one after the other
+        self.n_blends = n_blends
+        self.frame_samples = frame_samples
+        self.entry, self.offset = 0, 0
+
+    def __len__(self):
+        return self.n_blends + len(self.starts)
+
+class AudioLoop:
+    # one capture and one playback thread around a preallocated ring of samples. Every frame gathered
+    # into the video buffer marks the ring position it was captured at, so a loop sequence of video
+    # frames maps to the samples recorded with them. Playback follows the position of the first video
+    # output, ahead by the device latency; outside of a loop the live audio is passed through.
+    rate = 48000
+    channels = 1
+    period_size = 480 # samples per period, 10 ms at 48 kHz
+    periods = 4 # periods held by the playback device, the latency is periods * period_size
+    max_drift = 1 # periods playback may drift from the video before it jumps back in step
+
+    def __init__(self, capture_device: str = 'default', playback_device: str = 'hw:Loopback,0',
+            rate: int = None, channels: int = None, period_size: int = None, periods: int = None,
+            passthrough: bool = True):
+        self.capture_device, self.playback_device = capture_device, playback_device
+        if rate is not None:
+            self.rate = rate
+        if channels is not None:
+            self.channels = channels
+        if period_size is not None:
+            self.period_size = period_size
+        if periods is not None:
+            self.periods = periods
+        self.passthrough = passthrough # play the live audio while not looping, otherwise silence
+
+        self.looper = None # set by VideoLooper
+        self.frame_samples = 0
+        self._ring = None
+        self._written = 0 # samples written to the ring since allocate(), the ring holds the last len(_ring)
+        self._marks = None # ring position of each video frame gathered, by frame count
+        self._mark_count = 0
+        self._freeze_at = 0
+
+        self._sequence = None # LoopAudio played while looping
+        self._live_pos = 0
+
+        self._period = np.zeros((self.period_size, self.channels), dtype = np.int16)
+        self._silence = np.zeros_like(self._period)
+
+        self._capture_pcm, self._playback_pcm = None, None
+        self._threads = []
+        self._running = False
+
+    @property
+    def latency(self):
+        return self.periods * self.period_size / self.rate
+
+    def allocate(self, capacity: int, fps: float):
+        # sized for twice the video buffer, so timing jitter between the two never overwrites loop audio
+        self.frame_samples = round(self.rate / fps)
+        self._marks = np.zeros(capacity, dtype = np.int64)
+        self._ring = np.zeros((2 * capacity * self.frame_samples + self.periods * self.period_size, self.channels),
+            dtype = np.int16)
+        self._written = 0
+        self._sequence = None
+        self.clear()
+
+    def clear(self):
+        self._mark_count = 0
+        self._freeze_at = 0
+
+    def mark_frame(self):
+        # called with every frame appended to the video buffer
+        self._marks[self._mark_count % len(self._marks)] = self._written
+        self._mark_count += 1
+
+    def _frame_start(self, i: int, n: int) -> int:
+        # ring position of video buffer frame i of n; the buffers append in lockstep, counted from the newest
+        m = self._mark_count - n + i
+        if m < 0 or m < self._mark_count - len(self._marks):
+            return -1
+        start = int(self._marks[m % len(self._marks)])
+        if self._written - start > len(self._ring) - self.frame_samples:
+            return -1 # overwritten already
+        return start
+
+    def set_sequence(self, sequence, n_frames: int):
+        # works out the samples for every entry of a loop sequence of the video buffer's n_frames frames;
+        # runs once when looping starts, so playback only copies
+        if self._ring is None:
+            return
+        if len(sequence) == 0:
+            self._sequence = None
+            return
+        self._freeze_at = int(self._marks[(self._mark_count - 1) % len(self._marks)]) + self.frame_samples \
+            if self._mark_count else 0
+
+        starts = np.array([self._frame_start(i, n_frames) for i in sequence.order], dtype = np.int64)
+        pairs = getattr(sequence, 'blend_pairs', None) or []
+        blends = np.zeros((len(pairs) * self.frame_samples, self.channels), dtype = np.int16)
+        if pairs:
+            # the fade runs sample by sample across all blended frames
+            tail = np.concatenate([self._read(self._frame_start(t, n_frames), self.frame_samples) for t, h in pairs])
+            head = np.concatenate([self._read(self._frame_start(h, n_frames), self.frame_samples) for t, h in pairs])
+            weights = (np.arange(1, len(blends) + 1, dtype = np.float32) / (len(blends) + 1))[:, None]
+            blend = head.astype(np.float32)
+            blend -= tail
+            blend *= weights
+            blend += tail
+            np.copyto(blends, np.rint(blend), casting = 'unsafe')
+
+        self._sequence = LoopAudio(starts, blends, len(pairs), self.frame_samples)
+
+    def _read(self, start: int, n: int, out: np.ndarray = None) -> np.ndarray:
+        # n samples from ring position start, zeros where they are missing
+        if out is None:
+            out = np.empty((n, self.channels), dtype = np.int16)
+        ring = self._ring
+        if start < 0 or start + n > self._written or self._written - start > len(ring):
+            out[:] = 0
+            return out
+        i = start % len(ring)
+        first = min(n, len(ring) - i)
+        out[:first] = ring[i:i + first]
+        out[first:] = ring[:n - first]
+        return out
+
+    def _write(self, samples: np.ndarray):
+        ring = self._ring
+        n = min(len(samples), len(ring))
+        i = self._written % len(ring)
+        first = min(n, len(ring) - i)
+        ring[i:i + first] = samples[:first]
+        ring[:n - first] = samples[first:n]
+        self._written += n
+
+    @property
+    def recording(self):
+        # the loop's samples are kept until looping stops; the newest frame still gets its samples
+        return not self.looper.playing_loop or self._written < self._freeze_at
+
+    def open(self):
+        # opens both sound devices; called where video is set up, so a missing device is reported there
+        # rather than from the video thread. stop() closes them.
+        try:
+            if self._capture_pcm is None:
+                self._capture_pcm = alsaaudio.PCM(alsaaudio.PCM_CAPTURE, device = self.capture_device,
+                    rate = self.rate, channels = self.channels, format = alsaaudio.PCM_FORMAT_S16_LE,
+                    periodsize = self.period_size, periods = self.periods)
+            if self._playback_pcm is None:
+                self._playback_pcm = alsaaudio.PCM(alsaaudio.PCM_PLAYBACK, device = self.playback_device,
+                    rate = self.rate, channels = self.channels, format = alsaaudio.PCM_FORMAT_S16_LE,
+                    periodsize = self.period_size, periods = self.periods)
+        except alsaaudio.ALSAAudioError as e:
+            raise OSError("Cannot open sound device: %s" % e) from e
+        return self
+
+    def start(self):
+        if self._running or self._ring is None:
+            return
+        self.open()
+
+        self._running = True
+        self._threads = [threading.Thread(target = self._run_capture, daemon = True),
+            threading.Thread(target = self._run_playback, daemon = True)]
+        for thread in self._threads:
+            thread.start()
+        logging.info("Audio loop from %s to %s, %.0f ms latency" % (
+            self.capture_device, self.playback_device, self.latency * 1000))
+
+    def stop(self):
+        self._running = False
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        for pcm in (self._capture_pcm, self._playback_pcm):
+            if pcm is not None:
+                pcm.close()
+        self._capture_pcm, self._playback_pcm = None, None
+
+    def _run_capture(self):
+        last_time = time.perf_counter()
+        while self._running:
+            length, data = self._capture_pcm.read()
+            now = time.perf_counter()
+            if length <= 0 or now - last_time > self.latency:
+                metrics.count('audio overrun')
+            last_time = now
+            if length > 0 and self.recording:
+                self._write(np.frombuffer(data, dtype = np.int16).reshape(-1, self.channels))
+
+    def _run_playback(self):
+        # the device is filled ahead by its whole buffer, so a late period never empties it
+        for i in range(self.periods):
+            self._playback_pcm.write(self._silence)
+
+        last_time = time.perf_counter()
+        while self._running:
+            start_time = time.perf_counter()
+            self._fill(self._period)
+            self._playback_pcm.write(self._period)
+            now = time.perf_counter()
+            metrics.record('audio period', start_time - last_time)
+            if now - last_time > self.latency:
+                metrics.count('audio underrun')
+            last_time = now
+
+    def _fill(self, out: np.ndarray):
+        # one period of playback, copied from preallocated buffers only
+        sequence = self._sequence
+        if self.looper.playing_loop and self.looper.clip is None and sequence is not None:
+            self._sync(sequence)
+            self._fill_loop(out, sequence)
+        elif self.passthrough and not self.looper.playing_loop:
+            # the live samples, kept between one and max_drift + 2 periods behind capture
+            behind = self._written - self._live_pos
+            if not self.period_size <= behind <= (self.max_drift + 2) * self.period_size:
+                self._live_pos = max(0, self._written - 2 * self.period_size)
+            self._read(self._live_pos, len(out), out)
+            self._live_pos += len(out)
+        else:
+            out[:] = 0
+
+    def _fill_loop(self, out: np.ndarray, sequence: LoopAudio):
+        n_entries, frame_samples, n_blends = len(sequence), sequence.frame_samples, sequence.n_blends
+        filled = 0
+        while filled < len(out):
+            take = min(len(out) - filled, frame_samples - sequence.offset)
+            if sequence.entry < n_blends:
+                i = sequence.entry * frame_samples + sequence.offset
+                out[filled:filled + take] = sequence.blends[i:i + take]
+            else:
+                start = sequence.starts[sequence.entry - n_blends]
+                self._read(start + sequence.offset if start >= 0 else -1, take, out[filled:filled + take])
+            filled += take
+            sequence.offset += take
+            if sequence.offset == frame_samples:
+                sequence.entry, sequence.offset = (sequence.entry + 1) % n_entries, 0
+
+    def _sync(self, sequence: LoopAudio):
+        # the samples written now are heard after the device latency, they belong to the frame shown then
+        channel = self.looper.channels[0]
+        if channel.loop_time is None:
+            return
+        frame_samples = sequence.frame_samples
+        n_total = len(sequence) * frame_samples
+        target = channel.loop_index * frame_samples + \
+            round((time.perf_counter() - channel.loop_time + self.latency) * self.rate)
+        target %= n_total
+        position = sequence.entry * frame_samples + sequence.offset
+        drift = (position - target + n_total // 2) % n_total - n_total // 2
+        if abs(drift) > self.max_drift * self.period_size:
+            metrics.count('audio resync')
+            sequence.entry, sequence.offset = divmod(target, frame_samples)
+
+    def __repr__(self):
+        return "AudioLoop<%s -> %s, %d / %d samples>" % (self.capture_device, self.playback_device,
+            min(self._written, 0 if self._ring is None else len(self._ring)), 0 if self._ring is None else len(self._ring))
@@ -0,0 +1,343 @@
+import argparse
+import datetime
+import itertools as it
+import json
+import os
+import pathlib
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+import camera
+from metrics import metrics
+
+# measures VideoLooper without camera or loopback hardware, e.g.
+#   python3 src/benchmark.py --output new.json --compare old.json looper
+#   python3 src/benchmark.py startup --clear-cache
+#   python3 src/benchmark.py meetings --count 100000
+
+COMPRESSIONS = {'none': None, 'yuv420': 'yuv420', 'jpeg': 'jpeg'}
+
+def parse_sizes(text: str):
+    sizes = []
+    for item in text.split(','):
+        width, height = item.lower().split('x')
+        sizes.append((int(width), int(height)))
+    return sizes
+
+def parse_list(text: str, convert = str):
+    return [convert(item) for item in text.split(',')]
+
+def environment():
+    try:
+        revision = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+            capture_output = True, text = True, check = True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        revision = None
+    return {
+        'revision': revision,
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'time': time.time(),
+    }
+
+def bench_looper(size, num_seconds: float, mode: str, compression: str, duration: float, fps: float,
+        dedup: bool = False):
+    # mode 'live' passes camera frames through, 'loop' plays back the filled buffer
+    input_cam = camera.SyntheticCamera(size, fps = fps or None, layout = camera.ROW_MAJOR).init()
+    output_cam = camera.NullOutputCamera(size).init()
+
+    tracemalloc.start()
+    base_bytes = tracemalloc.get_traced_memory()[0]
+    looper = camera.VideoLooper(input_cam, output_cam, num_seconds = num_seconds,
+        compression = COMPRESSIONS[compression], dedup = dedup)
+    looper.pacer.set_fps(fps)
+    try:
+        fill_time = None
+        if mode == 'loop':
+            start_time = time.perf_counter()
+            looper.start()
+            while not looper.can_loop:
+                time.sleep(0.001)
+            fill_time = time.perf_counter() - start_time
+            looper.is_looping = True
+
+        metrics.reset()
+        output_cam.frames_written = 0
+        start_time = time.perf_counter()
+        while time.perf_counter() - start_time < duration:
+            looper.loop()
+        elapsed = time.perf_counter() - start_time
+        snapshot = metrics.snapshot()
+        buffer_bytes = looper.buffer.nbytes
+    finally:
+        looper.close()
+        peak_bytes = tracemalloc.get_traced_memory()[1] - base_bytes
+        tracemalloc.stop()
+        input_cam.release()
+        output_cam.release()
+
+    # the output step: the write plus, when live, the wait for the next camera frame
+    frame_stage = snapshot['stages'].get('frame', {})
+    # capture to output: from the camera read returning until the frame is written, live only
+    latency_stage = snapshot['stages'].get('latency')
+    return {
+        'size': list(size),
+        'num_seconds': num_seconds,
+        'mode': mode,
+        'compression': compression,
+        'dedup': dedup,
+        'fps': fps,
+        'duration': elapsed,
+        'frames': output_cam.frames_written,
+        'throughput_fps': output_cam.frames_written / elapsed,
+        'step_p50_ms': frame_stage.get('p50_ms', 0.),
+        'step_p95_ms': frame_stage.get('p95_ms', 0.),
+        'latency_p50_ms': None if latency_stage is None else latency_stage['p50_ms'],
+        'latency_p95_ms': None if latency_stage is None else latency_stage['p95_ms'],
+        'fill_time': fill_time,
+        'buffer_bytes': buffer_bytes,
+        'peak_traced_bytes': peak_bytes,
+        'stages': {name: {k: s[k] for k in ('count', 'mean_ms', 'p50_ms', 'p95_ms', 'max_ms')}
+            for name, s in snapshot['stages'].items()},
+        'counters': snapshot['counters'],
+    }
+
+def run_looper(args):
+    cases = []
+    for size, num_seconds, mode, compression, dedup in it.product(
+            parse_sizes(args.sizes), parse_list(args.seconds, float), parse_list(args.modes), parse_list(args.compression),
+            parse_list(args.dedup, lambda text: text == 'on')):
+        if dedup and compression != 'none':
+            continue # only raw buffers deduplicate
+        case = bench_looper(size, num_seconds, mode, compression, args.duration, args.fps, dedup)
+        latency = '' if case['latency_p50_ms'] is None else "  latency p50 %6.2f ms  p95 %6.2f ms" % (
+            case['latency_p50_ms'], case['latency_p95_ms'])
+        print("%-28s %8.1f fps  step p50 %6.2f ms  p95 %6.2f ms%s  buffer %7.1f MB  peak %7.1f MB" % (
+            case_key(case), case['throughput_fps'], case['step_p50_ms'], case['step_p95_ms'], latency,
+            case['buffer_bytes'] / 2**20, case['peak_traced_bytes'] / 2**20), file = sys.stderr)
+        cases.append(case)
+    return cases
+
+# runs in a fresh interpreter from the repository root, so every run pays the full import cost
+STARTUP_SCRIPT = """
+import json, sys, time
+start_time = time.perf_counter()
+sys.path.insert(0, 'src')
+from PyQt5 import QtWidgets
+import main
+from meeting_ui import MeetingEditDialog
+import_time = time.perf_counter()
+
+app = QtWidgets.QApplication(sys.argv[:1])
+with main.Ui() as window:
+    window.show()
+    app.processEvents()
+    window_time = time.perf_counter()
+
+    dialog_times = []
+    for i in range(2):
+        dialog_start = time.perf_counter()
+        dialog = MeetingEditDialog()
+        dialog.show()
+        app.processEvents()
+        dialog_times.append(time.perf_counter() - dialog_start)
+        dialog.close()
+
+print(json.dumps({
+    'import_s': import_time - start_time,
+    'window_s': window_time - start_time,
+    'dialog_first_s': dialog_times[0],
+    'dialog_reopen_s': dialog_times[1],
+}))
+"""
+
+def run_startup(args):
+    # the first run after --clear-cache measures a cold layout cache
+    import ui_loader
+    if args.clear_cache:
+        shutil.rmtree(ui_loader.get_cache_path(), ignore_errors = True)
+
+    env = dict(os.environ)
+    if 'DISPLAY' not in env and 'WAYLAND_DISPLAY' not in env:
+        env['QT_QPA_PLATFORM'] = 'offscreen'
+    root = pathlib.Path(__file__).resolve().parent.parent
+
+    runs = []
+    for i in range(args.runs):
+        result = subprocess.run([sys.executable, '-c', STARTUP_SCRIPT], cwd = root, env = env,
+            capture_output = True, text = True)
+        if result.returncode != 0:
+            raise RuntimeError("Startup run failed:\n%s" % result.stderr)
+        runs.append(json.loads(result.stdout.strip().splitlines()[-1]))
+        print("run %d: window %.3f s, dialog %.3f s then %.3f s" % (
+            i, runs[-1]['window_s'], runs[-1]['dialog_first_s'], runs[-1]['dialog_reopen_s']), file = sys.stderr)
+
+    case = {key: statistics.median(run[key] for run in runs) for key in runs[0]}
+    case.update({'runs': runs, 'first_run': runs[0]})
+    return [case]
+
+class FakeClock:
+    def __init__(self, now: datetime.datetime):
+        self.now = now
+    def __call__(self):
+        return self.now
+
+def bench_meetings(count: int, days: float, scan_ticks: int):
+    # meetings spread over the next days; time runs on a fake clock, so a simulated day takes seconds
+    import meeting_join
+    from meeting import Meeting
+
+    start = datetime.datetime(2020, 9, 1)
+    rng = random.Random(0)
+    meetings = [Meeting(str(1000000000 + i), '', '', start + datetime.timedelta(seconds = rng.uniform(1, days * 86400)))
+        for i in range(count)]
+    clock = FakeClock(start)
+    joined = []
+
+    start_time = time.perf_counter()
+    scheduler = meeting_join.MeetingScheduler(meetings, clock = clock, join = joined.append)
+    build_time = time.perf_counter() - start_time
+
+    # incremental updates, like editing from the GUI or the daemon
+    ops = 1000
+    extra, moved = [[Meeting(str(2000000000 + i), '', '', start + datetime.timedelta(seconds = rng.uniform(1, days * 86400)))
+        for i in range(ops)] for k in range(2)]
+    start_time = time.perf_counter()
+    for meeting in extra:
+        scheduler.add(meeting)
+    for i, meeting in enumerate(moved):
+        scheduler.replace(meetings[i], meeting)
+        meetings[i] = meeting
+    for meeting in extra:
+        scheduler.remove(meeting)
+    update_time = (time.perf_counter() - start_time) / (3 * ops)
+
+    # one timer wakeup per next_delay() until the simulated time is over
+    wakeups, tick_times = 0, []
+    end = start + datetime.timedelta(days = days)
+    while True:
+        delay = scheduler.next_delay()
+        if delay is None:
+            break
+        clock.now += datetime.timedelta(seconds = delay)
+        if clock.now > end:
+            break
+        tick_start = time.perf_counter()
+        scheduler.process()
+        tick_times.append(time.perf_counter() - tick_start)
+        wakeups += 1
+
+    # the old 1 Hz scan over the same list, for a few ticks
+    auto_join = meeting_join.MeetingAutoJoin()
+    start_time = time.perf_counter()
+    for i in range(scan_ticks):
+        auto_join.process(meetings)
+    scan_time = (time.perf_counter() - start_time) / scan_ticks
+
+    tick_times.sort()
+    return {
+        'count': count,
+        'days': days,
+        'build_s': build_time,
+        'update_us': update_time * 1e6,
+        'wakeups': wakeups,
+        'scan_wakeups': round(days * 86400),
+        'joined': len(joined),
+        'tick_p50_us': tick_times[len(tick_times) // 2] * 1e6 if tick_times else 0.,
+        'tick_max_us': tick_times[-1] * 1e6 if tick_times else 0.,
+        'scan_tick_us': scan_time * 1e6,
+    }
+
+def run_meetings(args):
+    cases = []
+    for count in parse_list(args.count, int):
+        case = bench_meetings(count, args.days, args.scan_ticks)
+        print("%7d meetings  build %6.3f s  update %5.1f us  %d wakeups (scan %d)  tick p50 %5.1f us  scan tick %8.1f us" % (
+            count, case['build_s'], case['update_us'], case['wakeups'], case['scan_wakeups'],
+            case['tick_p50_us'], case['scan_tick_us']), file = sys.stderr)
+        cases.append(case)
+    return cases
+
+def case_key(case):
+    if 'count' in case:
+        return 'meetings %d' % case['count']
+    if 'size' not in case:
+        return 'startup'
+    key = "%dx%d %gs %s %s" % (case['size'][0], case['size'][1], case['num_seconds'], case['mode'], case['compression'])
+    return key + ' dedup' if case.get('dedup') else key
+
+def compare(cases, baseline):
+    # prints the throughput and step time of each case relative to an earlier result file
+    old_cases = {case_key(case): case for case in baseline['cases']}
+    for case in cases:
+        old = old_cases.get(case_key(case))
+        if old is None:
+            continue
+        if 'count' in case:
+            print("%-28s tick p50 %.1f -> %.1f us  wakeups %d -> %d" % (
+                case_key(case), old['tick_p50_us'], case['tick_p50_us'], old['wakeups'], case['wakeups']))
+            continue
+        if 'window_s' in case:
+            print("startup  window %.3f -> %.3f s  dialog reopen %.3f -> %.3f s" % (
+                old['window_s'], case['window_s'], old['dialog_reopen_s'], case['dialog_reopen_s']))
+            continue
+        # live cases only, and not in files written before latency was measured
+        latency = '' if case['latency_p95_ms'] is None or old.get('latency_p95_ms') is None else \
+            "  latency p95 %+.2f ms" % (case['latency_p95_ms'] - old['latency_p95_ms'])
+        print("%-28s throughput x%.2f  step p95 %+.2f ms%s  peak %+.1f MB" % (
+            case_key(case), case['throughput_fps'] / max(old['throughput_fps'], 1e-9),
+            case['step_p95_ms'] - old.get('step_p95_ms', old.get('frame_p95_ms', 0.)), # frame_p95_ms in older files
+            latency, (case['peak_traced_bytes'] - old['peak_traced_bytes']) / 2**20))
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = "Hardware-free mmhZoom benchmarks")
+    parser.add_argument('--output', help = "write JSON results to this file instead of stdout")
+    parser.add_argument('--compare', help = "JSON results of an earlier run to compare against")
+    subparsers = parser.add_subparsers(dest = 'benchmark', required = True)
+
+    looper_parser = subparsers.add_parser('looper', help = "VideoLooper throughput, output step time, latency and memory")
+    looper_parser.add_argument('--sizes', default = '320x240,640x480,1280x720')
+    looper_parser.add_argument('--seconds', default = '2,10', help = "loop lengths")
+    looper_parser.add_argument('--modes', default = 'live,loop')
+    looper_parser.add_argument('--compression', default = 'none,yuv420,jpeg')
+    looper_parser.add_argument('--dedup', default = 'off', help = "off, on or off,on; applies to raw buffers")
+    looper_parser.add_argument('--duration', type = float, default = 1., help = "seconds measured per case")
+    looper_parser.add_argument('--fps', type = float, default = 0., help = "output rate, 0 runs unpaced")
+    looper_parser.set_defaults(run = run_looper)
+
+    startup_parser = subparsers.add_parser('startup', help = "time until the window is shown, and opening a dialog")
+    startup_parser.add_argument('--runs', type = int, default = 5)
+    startup_parser.add_argument('--clear-cache', action = 'store_true', help = "start with no compiled layouts")
+    startup_parser.set_defaults(run = run_startup)
+
+    meetings_parser = subparsers.add_parser('meetings', help = "auto-join scheduling cost and wakeups")
+    meetings_parser.add_argument('--count', default = '1000,100000', help = "numbers of scheduled meetings")
+    meetings_parser.add_argument('--days', type = float, default = 7., help = "simulated time the meetings are spread over")
+    meetings_parser.add_argument('--scan-ticks', type = int, default = 10, help = "ticks of the old full scan measured")
+    meetings_parser.set_defaults(run = run_meetings)
+
+    args = parser.parse_args(argv)
+    results = {'benchmark': args.benchmark, 'environment': environment(), 'cases': args.run(args)}
+
+    data = json.dumps(results, indent = 1)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(data)
+    else:
+        print(data)
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results['cases'], json.load(f))
+
+if __name__ == "__main__":
+    main()
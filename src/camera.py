@@ -6,80 +6,168 @@ import abc
 
 # unfortunately, OpenCV is incompatible with PyQt5, so pyfakewebcam will suffer degraded performance
 #import cv2
-import pygame
-import pygame.camera
-
-pygame.init()
-pygame.camera.init()
 
 import pyfakewebcam
+import v4l2_output
+import devices
+from metrics import metrics
 
 import contextlib
 import threading
+import collections
+import json
+import queue
+import subprocess
 
 import itertools as it
+import os
+
+from loop_buffer import make_frame_buffer
+from pacing import FramePacer
+from frame_queue import FramePool, FrameQueue, FrameSlot
+from quality import QualityController, Rescaler
+from loop_point import LoopPointFinder, LoopSequence, crossfade
+
+pygame = None # loaded by init_pygame() when a camera is first opened, importing it is slow
+_pygame_mutex = threading.Lock()
+
+def init_pygame():
+    global pygame
+    with _pygame_mutex:
+        if pygame is None:
+            import pygame.camera
+            pygame.camera.init()
+
+# frame memory layouts
+COLUMN_MAJOR = 'column-major' # (W, H, 3), pygame.surfarray order
+ROW_MAJOR = 'row-major' # (H, W, 3), image order expected by v4l2 and QImage
+YUYV = 'yuyv' # (H, 2W), packed YUYV 4:2:2 as written to the loopback device
 
 class InputCamera(abc.ABC):
-    pass
+    size = None
+    layout = COLUMN_MAJOR
+
+    @abc.abstractmethod
+    def read(self, out: np.ndarray = None) -> np.ndarray:
+        pass
+
+    @property
+    def frame_shape(self):
+        if self.size is None:
+            return None
+        width, height = self.size
+        return (width, height, 3) if self.layout == COLUMN_MAJOR else (height, width, 3)
+
+    def suspend(self):
+        # stops the stream while frames are not needed, sources that cost nothing when idle keep it running
+        pass
+
+    def resume(self):
+        pass
+
+    def reopen(self, size, fps: float = None):
+        # restarts capture at another size, and rate for sources that have one
+        self.release()
+        self.size = size
+        if fps is not None and getattr(self, 'fps', None):
+            self.fps = fps
+        return self.init()
 
 class RealCamera(InputCamera):
-    def __init__(self, device_id, size = (640,480)):
+    pool_size = 3 # pooled frames returned by read() are overwritten after this many reads
+
+    def __init__(self, device_id, size = (640,480), layout = COLUMN_MAJOR):
         #if device_id is None:
         #    device_id = RealCamera.get_default_device()
 
         self.size = size
         self.device_id = device_id
+        self.layout = layout
 
         # create a display surface. standard pygame stuff
         #self.display = pygame.display.set_mode(self.size, 0)
         self._mutex = threading.Lock()
-        self.last_frame = None
+        self.latest = FrameSlot()
+
+        self._surface = None
+        self._pool = []
+        self._pool_index = 0
+        self.suspended = False
 
     @staticmethod
     def get_devices():
-        devices = pygame.camera.list_cameras()
-        fake_device_id = OutputCamera.get_default_device()
-        return [device_id for device_id in devices if device_id != fake_device_id]
+        # capture nodes of physical cameras, loopback devices are left out
+        return devices.registry.get_capture_devices()
 
     @staticmethod
     def get_default_device():
-        devices = RealCamera.get_devices()
-        if len(devices) == 0:
+        device_ids = RealCamera.get_devices()
+        if len(device_ids) == 0:
             raise ValueError("No camera available")
-        return devices[0]
+        return device_ids[0]
 
-    def read(self):
-        with self._mutex:
+    def _next_pool_buffer(self, shape) -> np.ndarray:
+        if len(self._pool) == 0 or self._pool[0].shape != shape:
+            self._pool = [np.empty(shape, dtype = np.uint8) for i in range(self.pool_size)]
+        out = self._pool[self._pool_index]
+        self._pool_index = (self._pool_index + 1) % len(self._pool)
+        return out
+
+    def read(self, out: np.ndarray = None):
+        with self._mutex, metrics.time('capture'):
+            if self.suspended:
+                return None # the stream is stopped, get_image would fail
             # https://stackoverflow.com/questions/39003106/python-access-camera-without-opencv?noredirect=1&lq=1
-            frame : pygame.Surface = self.vid.get_image()
-            frame : np.array = pygame.surfarray.array3d(frame) # slow :(
+            # reuse the capture surface and copy straight out of its pixels, instead of array3d allocating per frame
+            if self._surface is None:
+                self._surface = self.vid.get_image()
+            else:
+                self._surface = self.vid.get_image(self._surface)
+
+            pixels : np.array = pygame.surfarray.pixels3d(self._surface) # view, locks the surface
+            if self.layout == ROW_MAJOR:
+                pixels = pixels.transpose((1,0,2))
+
+            if out is None:
+                out = self._next_pool_buffer(pixels.shape)
+            np.copyto(out, pixels)
+            del pixels # unlock the surface
 
             #ret, frame = self.vid.read()
             #if not ret: return None
 
-            self.last_frame = frame
+            self.latest.publish(out)
 
-            return frame
+            return out
 
             #rgb_frame = frame[:,:,[2,1,0]] # BGR to RGB color conversion
             #return rgb_frame
 
     def read_transposed(self):
+        if self.layout == ROW_MAJOR:
+            return self.read()
         return np.transpose(self.read(), (1,0,2))
 
-    def read_recent_frame(self):
-        with self._mutex:
-            if self.last_frame is None:
-                ret = None
-            else:
-                ret = self.last_frame.copy()
-        return ret
+    @property
+    def last_frame(self):
+        return self.latest.frame
+
+    def read_recent_frame(self, copy = True):
+        # without copy, the frame is a pooled buffer that a later read() will overwrite
+        while True:
+            seq, frame = self.latest.read()
+            if frame is None or not copy:
+                return frame
+            frame = frame.copy()
+            if self.latest.valid(seq):
+                return frame
 
     def skip(self, n_frames):
         for i in range(n_frames):
             self.vid.read()
 
     def init(self):
+        init_pygame()
         self.vid = pygame.camera.Camera(self.device_id, self.size)
         self.vid.start()
 
@@ -94,8 +182,24 @@ class RealCamera(InputCamera):
         self.init()
         return self
 
+    def suspend(self):
+        # frees the USB bandwidth and lets the sensor power down; resume() takes a while to warm up
+        with self._mutex:
+            if not self.suspended:
+                self.vid.stop()
+                self.suspended = True
+
+    def resume(self):
+        with self._mutex:
+            if self.suspended:
+                self.vid.start()
+                self.suspended = False
+
     def release(self):
-        self.vid.stop()
+        if not self.suspended:
+            self.vid.stop()
+        self.suspended = False
+        self._surface = None
         #self.vid.release() # OpenCV
 
     def __exit__(self, exc_type, exc_val, exc_tb):
@@ -104,20 +208,344 @@ class RealCamera(InputCamera):
     def __repr__(self):
         return "RealCamera(%r)" % (self.device_id, )
 
+class SyntheticCamera(InputCamera):
+    # a gradient scrolling sideways at a configurable size and rate, for running without a camera
+    scroll = 4 # pixels per frame
+    def __init__(self, size = (640,480), fps: float = None, layout = COLUMN_MAJOR):
+        self.size = size
+        self.fps = fps
+        self.layout = layout
+        self.device_id = 'synthetic %dx%d' % tuple(size)
+        self.latest = FrameSlot()
+
+        self._pattern = None
+        self._pool = []
+        self._pool_index = 0
+        self._deadline = None
+        self.frame_index = 0
+
+    def init(self):
+        width, height = self.size
+        x = np.arange(width, dtype = np.int64)[:, None] # x * 255 overflows 16 bits past 257 pixels
+        y = np.arange(height, dtype = np.int64)[None, :]
+        pattern = np.empty((width, height, 3), dtype = np.uint8)
+        pattern[:, :, 0] = (x * 255 // max(1, width - 1))
+        pattern[:, :, 1] = (y * 255 // max(1, height - 1))
+        pattern[:, :, 2] = ((x + y) % 256)
+        self._pattern = pattern if self.layout == COLUMN_MAJOR else np.ascontiguousarray(pattern.transpose((1,0,2)))
+        self._pool = [np.empty(self.frame_shape, dtype = np.uint8) for i in range(RealCamera.pool_size)]
+        self._deadline = None
+        return self
+
+    def read(self, out: np.ndarray = None):
+        with metrics.time('capture'):
+            if self.fps:
+                now = time.monotonic()
+                self._deadline = now if self._deadline is None else max(now, self._deadline + 1 / self.fps)
+                time.sleep(self._deadline - now)
+
+            if out is None:
+                out = self._pool[self._pool_index]
+                self._pool_index = (self._pool_index + 1) % len(self._pool)
+            # the picture moves from frame to frame, so consecutive frames are never duplicates
+            axis = 0 if self.layout == COLUMN_MAJOR else 1
+            width = self._pattern.shape[axis]
+            shift = self.frame_index * self.scroll % width
+            pattern, target = np.moveaxis(self._pattern, axis, 0), np.moveaxis(out, axis, 0)
+            target[:width - shift] = pattern[shift:]
+            target[width - shift:] = pattern[:shift]
+            self.frame_index += 1
+
+        self.latest.publish(out)
+        return out
+
+    def __enter__(self):
+        return self.init()
+
+    def release(self):
+        self._pattern = None
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+
+    def __repr__(self):
+        return "SyntheticCamera(%r, %r)" % (self.size, self.fps)
+
+class VideoFileCamera(InputCamera):
+    # plays a video file through an ffmpeg subprocess, decoding raw frames on a background thread
+    # into a small set of reused buffers, so memory stays the same whatever the clip length
+    prefetch_frames = 4
+    pool_size = RealCamera.pool_size # frames returned by read() are overwritten after this many reads
+    startup_timeout = 5. # seconds to wait for ffmpeg's first frame after starting or seeking
+
+    def __init__(self, path: str, size = None, fps: float = None, layout = ROW_MAJOR, loop: bool = True):
+        # size defaults to the file's own, fps to the looper's rate; ffmpeg scales and resamples to them
+        self.path = path
+        self.device_id = path
+        self.size = size
+        self.fps = fps
+        self.layout = layout
+        self.loop = loop
+        self.latest = FrameSlot()
+        self.duration = None
+        self.finished = False
+
+        self._mutex = threading.Lock()
+        self._free = queue.Queue()
+        self._ready = queue.Queue()
+        self._handed_out = collections.deque()
+        self._generation = 0
+        self._restart = threading.Event()
+        self._start_time = 0.
+        self._process = None
+        self._thread = None
+        self._running = False
+        self._pacer = None
+        self._starting = True
+
+    @staticmethod
+    def is_video_file(path) -> bool:
+        return isinstance(path, str) and os.path.isfile(path)
+
+    def probe(self):
+        result = subprocess.run(['ffprobe', '-v', 'error', '-select_streams', 'v:0',
+                '-show_entries', 'stream=width,height,r_frame_rate:format=duration', '-of', 'json', self.path],
+            capture_output = True, text = True)
+        if result.returncode != 0:
+            raise ValueError("Cannot read video file %s: %s" % (self.path, result.stderr.strip()))
+        info = json.loads(result.stdout)
+        if not info.get('streams'):
+            raise ValueError("No video stream in %s" % self.path)
+        stream = info['streams'][0]
+        duration = info.get('format', {}).get('duration')
+        return (stream['width'], stream['height']), float(duration) if duration else None
+
+    def init(self):
+        native_size, self.duration = self.probe()
+        if self.size is None:
+            self.size = native_size
+        if self.fps is None:
+            self.fps = VideoLooper.fps
+
+        width, height = self.size
+        self._free, self._ready = queue.Queue(), queue.Queue()
+        self._handed_out.clear()
+        for i in range(self.prefetch_frames + self.pool_size):
+            self._free.put(np.empty((height, width, 3), dtype = np.uint8))
+        self._pacer = FramePacer(self.fps)
+        self._starting = True
+        self.finished = False
+
+        self._running = True
+        self._thread = threading.Thread(target = self._decode, daemon = True)
+        self._thread.start()
+        return self
+
+    def _spawn(self, start_time: float):
+        width, height = self.size
+        args = ['ffmpeg', '-nostdin', '-v', 'error']
+        if self.loop:
+            args += ['-stream_loop', '-1']
+        if start_time:
+            args += ['-ss', '%.3f' % start_time]
+        args += ['-i', self.path, '-an', '-vf', 'fps=%g,scale=%d:%d' % (self.fps, width, height),
+            '-f', 'rawvideo', '-pix_fmt', 'rgb24', '-']
+        return subprocess.Popen(args, stdout = subprocess.PIPE, stderr = subprocess.DEVNULL)
+
+    def _get_free(self):
+        while self._running:
+            try:
+                return self._free.get(timeout = 0.1)
+            except queue.Empty:
+                pass
+        return None
+
+    def _decode(self):
+        # producer, blocks when every buffer is either prefetched or still held by the reader
+        while self._running:
+            with self._mutex:
+                self._restart.clear()
+                generation = self._generation
+                process = self._process = self._spawn(self._start_time)
+            ended = False
+            try:
+                while self._running and generation == self._generation:
+                    buffer = self._get_free()
+                    if buffer is None:
+                        break
+                    view = memoryview(buffer).cast('B')
+                    while len(view):
+                        n = process.stdout.readinto(view)
+                        if not n:
+                            break
+                        view = view[n:]
+                    if len(view):
+                        self._free.put(buffer)
+                        ended = generation == self._generation
+                        break
+                    self._ready.put((generation, buffer))
+            finally:
+                process.kill()
+                process.wait()
+                process.stdout.close()
+
+            if ended:
+                # end of file, with loop on ffmpeg's -stream_loop never gets here; wait for a seek
+                self._ready.put((generation, None))
+                self._restart.wait()
+
+    def _drain(self):
+        while True:
+            try:
+                generation, buffer = self._ready.get_nowait()
+            except queue.Empty:
+                return
+            if buffer is not None:
+                self._free.put(buffer)
+
+    def seek(self, seconds: float):
+        # restarts decoding at the given position, frames already prefetched are thrown away
+        with self._mutex:
+            if self.duration and self.loop:
+                seconds %= self.duration
+            self._start_time = max(0., seconds)
+            self._generation += 1
+            self._starting = True
+            self.finished = False
+            if self._process is not None:
+                self._process.kill()
+            self._restart.set()
+        self._drain()
+
+    def rewind(self):
+        self.seek(0.)
+
+    def _next_frame(self):
+        # returns the next decoded buffer of the current generation, None at the end of the file
+        while self._running:
+            try:
+                generation, buffer = self._ready.get(timeout = self.startup_timeout if self._starting else 1 / self.fps)
+            except queue.Empty:
+                return None # decoder is late, the looper repeats the previous frame
+            if generation != self._generation:
+                if buffer is not None:
+                    self._free.put(buffer)
+                continue
+            if buffer is None:
+                self.finished = True
+            self._starting = False
+            return buffer
+        return None
+
+    def _recycle(self, buffer):
+        self._handed_out.append(buffer)
+        while len(self._handed_out) > self.pool_size:
+            self._free.put(self._handed_out.popleft())
+
+    def read(self, out: np.ndarray = None):
+        # paced to fps like a camera; frames we fell behind on are skipped to keep real time
+        starting = self._starting
+        missed = 0 if starting else self._pacer.wait()
+        with metrics.time('capture'):
+            if self.finished:
+                return None
+            for i in range(missed):
+                buffer = self._next_frame()
+                if buffer is None:
+                    return None
+                self._free.put(buffer)
+
+            buffer = self._next_frame()
+            if buffer is None:
+                return None
+            if starting:
+                self._pacer.reset() # waiting for ffmpeg does not count as falling behind
+
+            frame = buffer if self.layout == ROW_MAJOR else buffer.transpose((1,0,2))
+            if out is not None:
+                np.copyto(out, frame)
+                self._free.put(buffer)
+                frame = out
+            else:
+                self._recycle(buffer)
+
+        self.latest.publish(frame)
+        return frame
+
+    def __enter__(self):
+        return self.init()
+
+    def release(self):
+        with self._mutex:
+            self._running = False
+            if self._process is not None:
+                self._process.kill()
+            self._restart.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self._drain()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+
+    def __repr__(self):
+        return "VideoFileCamera(%r, %r, %r)" % (self.path, self.size, self.fps)
+
+def open_input_camera(device_id, layout = COLUMN_MAJOR) -> InputCamera:
+    # a path to a video file plays the file, anything else is a camera device
+    if VideoFileCamera.is_video_file(device_id):
+        # scaled to the camera size, which the output devices are opened with
+        return VideoFileCamera(device_id, size = (640,480), layout = layout).init()
+    return RealCamera(device_id, layout = layout).init()
+
 class OutputCamera:
     @staticmethod
     def get_default_device():
-        return '/dev/video2' # TODO: dynamically allocate device
+        loopback_devices = devices.registry.get_loopback_devices()
+        if len(loopback_devices) == 0:
+            raise ValueError("No v4l2loopback device available")
+        return loopback_devices[0]
+
+    # full-range (JPEG) YCbCr, as negotiated by pyfakewebcam
+    _rgb2yuv = np.array([[0.299, 0.587, 0.114],
+                         [-0.168736, -0.331264, 0.5],
+                         [0.5, -0.418688, -0.081312]], dtype = np.float32)
+
+    # output backends
+    PYFAKEWEBCAM = 'pyfakewebcam' # takes RGB frames only, through FakeWebcam.schedule_frame
+    V4L2 = 'v4l2' # v4l2_output.V4l2Writer, writes packed frames without intermediate copies
+    BACKENDS = (V4L2, PYFAKEWEBCAM)
 
-    def __init__(self, device_id = None, size = (640,480)):
+    def __init__(self, device_id = None, size = (640,480), backend = V4L2):
         #if device_id is None:
         #    device_id = OutputCamera.find_output_video_device()
 
         self.size = size
         self.device_id = device_id
+        self.backend = backend
+
+        self._convert_mutex = threading.Lock()
+        self._yuv = None
+        self._native = None
+
+    @property
+    def writes_native(self):
+        # whether packed YUYV frames can be written as they are, see write_native()
+        return self.backend != OutputCamera.PYFAKEWEBCAM
+
+    @property
+    def native_shape(self):
+        width, height = self.size
+        return (height, 2 * width)
 
     def init(self):
-        self.vid = pyfakewebcam.FakeWebcam(self.device_id, self.size[0], self.size[1])
+        if self.backend == OutputCamera.V4L2:
+            self.vid = v4l2_output.V4l2Writer(self.device_id, self.size[0], self.size[1])
+        elif self.backend == OutputCamera.PYFAKEWEBCAM:
+            self.vid = pyfakewebcam.FakeWebcam(self.device_id, self.size[0], self.size[1])
+        else:
+            raise ValueError("Unknown output backend %r" % self.backend)
         return self
 
     def __enter__(self):
@@ -125,14 +553,90 @@ class OutputCamera:
         return self
 
     def release(self):
+        if self.backend == OutputCamera.V4L2:
+            self.vid.close()
         del self.vid
         #self.vid.release()
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         self.release()
 
-    def write(self, frame: np.array):
-        self.vid.schedule_frame(np.transpose(frame, (1,0,2)))
+    def convert(self, frame: np.array, layout = COLUMN_MAJOR, out: np.ndarray = None) -> np.ndarray:
+        # RGB to the device's packed YUYV, vectorized into preallocated buffers
+        if layout == YUYV:
+            return frame
+        if layout == COLUMN_MAJOR:
+            frame = np.transpose(frame, (1,0,2))
+
+        width, height = self.size
+        if frame.shape[:2] != (height, width):
+            raise ValueError("Frame size %r does not match output size %r" % (frame.shape[1::-1], self.size))
+        if out is None:
+            out = np.empty(self.native_shape, dtype = np.uint8)
+
+        with self._convert_mutex, metrics.time('convert'):
+            if self._yuv is None:
+                self._yuv = np.empty((height, width, 3), dtype = np.float32)
+            yuv = self._yuv
+            np.matmul(frame, self._rgb2yuv.T, out = yuv)
+
+            # each pixel pair shares the average of its chroma
+            chroma = yuv[:, 0::2, 1:]
+            chroma += yuv[:, 1::2, 1:]
+            chroma *= 0.5
+            chroma += 128
+            yuv += 0.5 # round on the truncating cast below
+            np.clip(yuv, 0, 255, out = yuv)
+
+            out[:, 0::2] = yuv[:, :, 0]
+            out[:, 1::4] = chroma[:, :, 0]
+            out[:, 3::4] = chroma[:, :, 1]
+        return out
+
+    def write_native(self, data: np.ndarray):
+        if not self.writes_native:
+            raise ValueError("The %s backend cannot write packed frames" % self.backend)
+        with metrics.time('write'):
+            self.vid.write(data)
+
+    def write(self, frame: np.array, layout = COLUMN_MAJOR):
+        if layout == YUYV:
+            self.write_native(frame)
+            return
+        if not self.writes_native:
+            if layout == COLUMN_MAJOR:
+                frame = np.transpose(frame, (1,0,2))
+            with metrics.time('write'):
+                self.vid.schedule_frame(frame) # converts to YUYV itself
+            return
+
+        if self._native is None:
+            self._native = np.empty(self.native_shape, dtype = np.uint8)
+        self.write_native(self.convert(frame, layout, self._native))
+
+class NullOutputCamera(OutputCamera):
+    # converts like a loopback device but discards the frames, keeping only the last one and counts
+    def __init__(self, size = (640,480)):
+        super(NullOutputCamera, self).__init__('null', size)
+        self.frames_written = 0
+        self.bytes_written = 0
+        self.last_frame = None
+
+    def init(self):
+        self.vid = None
+        return self
+
+    def release(self):
+        pass
+
+    def write_native(self, data: np.ndarray):
+        with metrics.time('write'):
+            self.last_frame = data
+            self.frames_written += 1
+            self.bytes_written += data.nbytes
+
+    def __repr__(self):
+        return "NullOutputCamera(%r)" % (self.size, )
 
 class CycleLoop:
     def __init__(self, n):
@@ -142,24 +646,195 @@ class CycleLoop:
     def __iter__(self):
         return it.cycle(range(self.n))
 
+class OutputChannel:
+    # one output device fed by a VideoLooper, paced on its own so a slow device cannot hold up the others
+    def __init__(self, looper: 'VideoLooper', output_camera: OutputCamera, pool: FramePool):
+        self.looper = looper
+        self.output_camera = output_camera
+        self.queue = FrameQueue(pool = pool)
+        self.pacer = FramePacer(looper.fps)
+
+        self._generator = iter(CycleLoop(0))
+        self.loop_index, self.loop_time = 0, None # the loop entry written last and when, followed by audio
+        self._thread = None
+        self._running = False
+
+        self.name = '' if looper.output_cameras[0] is output_camera else ' %s' % getattr(output_camera, 'device_id', '?')
+        self._dropped, self._duplicated = 0, 0
+
+    def restart_loop(self, n_frames: int):
+        self._generator = iter(CycleLoop(n_frames))
+        self.loop_time = None
+        self.queue.clear()
+
+    def step(self):
+        looper = self.looper
+        start_time = time.perf_counter()
+        if looper.playing_loop:
+            frame_index = next(self._generator)
+            frame = looper.loop_sequence[frame_index]
+            self.output_camera.write(frame, looper.playback_layout)
+            self.loop_index, self.loop_time = frame_index, start_time
+            self._wait(start_time, start_time, skip = True)
+        else:
+            # repeats the previous frame if the camera is late
+            frame = self.queue.get(timeout = looper.frame_delay / 2)
+            work_time = time.perf_counter()
+            if frame is not None:
+                self.output_camera.write(frame, looper.frame_layout)
+                capture_time = self.queue.pool.captured_at(frame)
+                if capture_time is not None:
+                    # from the camera handing over the frame until it is written, a repeated frame counts again
+                    metrics.record('latency' + self.name, time.perf_counter() - capture_time)
+            self._wait(start_time, work_time, skip = False)
+
+    def _wait(self, start_time, work_time, skip):
+        # start_time is when the step began, work_time when it stopped waiting for a live frame
+        wait_time = time.perf_counter()
+        metrics.record('frame' + self.name, wait_time - start_time)
+        if self.looper.quality is not None:
+            # only the time spent writing counts as load, waiting for the camera does not
+            self.looper.quality.observe('output' + self.name, wait_time - work_time)
+
+        missed = self.pacer.wait()
+        if skip:
+            # skip loop frames we fell behind on, so the loop keeps its real-time speed
+            for i in range(missed):
+                next(self._generator)
+        metrics.record('sleep' + self.name, time.perf_counter() - wait_time)
+
+        metrics.set_gauge('fps' + self.name, self.pacer.achieved_fps)
+        metrics.set_gauge('jitter_ms' + self.name, self.pacer.jitter * 1000)
+        metrics.count('skipped' + self.name, missed)
+        metrics.count('dropped' + self.name, self.queue.dropped - self._dropped)
+        metrics.count('duplicated' + self.name, self.queue.duplicated - self._duplicated)
+        self._dropped, self._duplicated = self.queue.dropped, self.queue.duplicated
+        logging.debug("%r %r" % (self.output_camera, self.pacer))
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._running = True
+        self._thread = threading.Thread(target = self.run, daemon = True)
+        self._thread.start()
+
+    def run(self):
+        while self._running:
+            self.step()
+
+    def stop(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
 class VideoLooper:
     num_seconds = 2
     fps = 15.0
     frame_delay = 1 / fps
 
     buffer_capacity = math.ceil(fps * num_seconds)
+    crossfade_frames = 4
+    preroll = 1. # seconds the camera gets to warm up before prepare_live()'s time
     #skip_frames = 10
     #freeze_frames = round(fps * 1)
 
-    def __init__(self, input_camera: InputCamera, output_camera: OutputCamera):
+    def __init__(self, input_camera: InputCamera, output_camera,
+            num_seconds: float = None, compression: str = None, max_bytes: int = None,
+            native_buffer: bool = True, quality: QualityController = None,
+            crossfade_frames: int = None, ping_pong: bool = False, dedup: bool = False,
+            suspend_capture: bool = False, audio_loop: 'AudioLoop' = None):
+        # output_camera may be a list, every output shares the one capture and loop buffer
+        output_cameras = list(output_camera) if isinstance(output_camera, (list, tuple)) else [output_camera]
+        if len(output_cameras) == 0:
+            raise ValueError("VideoLooper needs an output camera")
+        # a compressed buffer decodes ahead for a single reader, outputs playing the loop side by side
+        # would recycle each other's frames
+        if compression is not None and len(output_cameras) > 1:
+            raise ValueError("A compressed loop buffer can only feed one output")
+
         self.input_camera = input_camera
-        self.output_camera = output_camera
-        self.buffer = []
+        self.output_cameras = output_cameras
+        self.output_camera = output_cameras[0]
+
+        # with a native buffer, frames are converted to the output's pixel format once on capture,
+        # and both live output and loop playback write them as they are
+        self.native = native_buffer and compression is None and all(getattr(o, 'writes_native', False) for o in output_cameras)
+        if self.native and len(set(tuple(o.size) for o in output_cameras)) > 1:
+            raise ValueError("Outputs sharing a native loop buffer must have the same size")
+        self.frame_layout = YUYV if self.native else input_camera.layout
+
+        # quality, when given, steps the capture size and frame rate to keep up; frames are scaled
+        # to the output size, so the output devices never see a format change
+        self.quality = quality
+        self._rescaler = None
+        if quality is not None:
+            self.fps = quality.level.fps
+            self.frame_delay = 1 / self.fps
+
+        # compression is None (raw frames), 'yuv420' or 'jpeg'; max_bytes caps the memory held by the buffer
+        if num_seconds is not None:
+            self.num_seconds = num_seconds
+        # dedup, off by default, stores near-identical consecutive raw frames once, so max_bytes holds more seconds
+        self.compression, self.max_bytes, self.dedup = compression, max_bytes, dedup
+        # audio_loop records room audio with the buffer and plays it with the loop
+        self.audio_loop = audio_loop
+        if audio_loop is not None:
+            audio_loop.looper = self
+        self.buffer = self._make_buffer()
 
         self._can_gather = True
         self._looping = False
 
-        self._generator = iter(CycleLoop(self.buffer_capacity))
+        self.clip, self.clip_layout = None, None # stored clip played instead of the buffer
+
+        # crossfade_frames blends the end of the loop into its start, ping_pong plays it forward and back
+        if crossfade_frames is not None:
+            self.crossfade_frames = crossfade_frames
+        self.ping_pong = ping_pong
+        self.loop_sequence = LoopSequence([], []) # frames played while looping, in order
+        self._blends = None
+
+        # live frames travel from the capture thread to each output through a drop-oldest queue,
+        # the first output is driven by loop(), the others by threads of their own
+        self.pool = FramePool()
+        self.channels = [OutputChannel(self, o, self.pool) for o in output_cameras]
+        self._capture_thread = None
+        self._capturing = False
+
+        # suspend_capture stops the camera while looping; it restarts preroll seconds before a time
+        # announced through prepare_live(), or right away when looping stops, and the loop keeps
+        # playing until the first live frame arrives
+        self.suspend_capture = suspend_capture
+        self._suspended = False
+        self._resuming = False
+        self._resume_at = None
+        self._wake = threading.Event()
+        self._gather_mutex = threading.Lock() # held while frames are added to the buffer or it is read as a whole
+
+    def _make_buffer(self):
+        self.buffer_capacity = math.ceil(self.fps * self.num_seconds)
+        buffer = make_frame_buffer(self.buffer_capacity, self.compression, self.max_bytes,
+            row_major = getattr(self.input_camera, 'layout', COLUMN_MAJOR) == ROW_MAJOR, dedup = self.dedup)
+        buffer.allocate(self.output_camera.native_shape if self.native else self.frame_shape)
+        self.loop_points = LoopPointFinder(buffer.capacity)
+        if self.audio_loop is not None:
+            self.audio_loop.allocate(self.buffer_capacity, self.fps)
+        return buffer
+
+    @property
+    def frame_shape(self):
+        # captured frames are scaled to the output size, in the camera's layout
+        width, height = self.output_camera.size
+        return (width, height, 3) if self.input_camera.layout == COLUMN_MAJOR else (height, width, 3)
+
+    @property
+    def pacer(self) -> FramePacer:
+        return self.channels[0].pacer
+
+    @property
+    def queue(self) -> FrameQueue:
+        return self.channels[0].queue
 
     def get_gather(self):
         return self._can_gather
@@ -173,48 +848,284 @@ class VideoLooper:
         return self._looping
 
     def set_looping(self, value: bool):
-        value = value and self.can_loop
-        self._looping = value
+        # the capture thread gathers under _gather_mutex, so the buffer holds still while the loop is
+        # worked out from it, and gathering has stopped by the time the mutex is released
+        with self._gather_mutex:
+            value = value and self.can_loop
+            if value and not self._looping and not self._resuming:
+                self.loop_sequence = self.make_loop_sequence() # also hands the playing order to the buffer
+                if self.audio_loop is not None and self.clip is None:
+                    self.audio_loop.set_sequence(self.loop_sequence, len(self.buffer))
+                for channel in self.channels:
+                    channel.restart_loop(len(self.loop_sequence))
+            if not value and self._looping:
+                self._resume_at = None
+                self._resuming = self._suspended
+                self._wake.set()
+            self._looping = value
+
+    @property
+    def playing_loop(self):
+        # outputs keep playing the loop while a suspended camera warms up after looping stopped
+        return self._looping or self._resuming
+
+    @property
+    def capture_suspended(self):
+        return self._suspended
+
+    def prepare_live(self, seconds: float):
+        # live video is needed in the given number of seconds, have the camera warm by then
+        self._resume_at = time.monotonic() + seconds - self.preroll
+        self._wake.set()
+
+    def _capture_needed(self):
+        if not self._looping:
+            return True
+        return self._resume_at is not None and time.monotonic() >= self._resume_at
 
     can_gather: bool = property(get_gather, set_gather) # unused, is_looping excludes frame gathering
     is_looping: bool = property(get_looping, set_looping)
 
     @property
     def can_loop(self):
-        return len(self.buffer) >= self.buffer_capacity
+        return self.clip is not None or self.buffer.full
+
+    def make_loop_sequence(self) -> LoopSequence:
+        # everything playback needs is worked out here, so writing a loop frame is a plain lookup
+        frames = self.playback_frames
+        n = len(frames) # a memory-capped buffer may hold fewer than buffer_capacity frames
+        if self.ping_pong:
+            # forward then back, the turns are continuous without blending
+            return LoopSequence(frames, list(range(n)) + list(range(n - 2, 0, -1)))
+
+        if self.clip is None:
+            start, end = self.loop_points.select(n)
+        else:
+            start, end = 0, n
+        logging.info("Loop frames %d to %d of %d" % (start, end, n))
+
+        # the last frames fade into the first ones and take their place at the head of the loop
+        fade = min(self.crossfade_frames, (end - start - 1) // 2)
+        if fade <= 0:
+            return LoopSequence(frames, range(start, end))
+
+        with metrics.time('crossfade'):
+            shape = (fade, ) + tuple(frames[start].shape)
+            if self._blends is None or self._blends.shape != shape:
+                self._blends = np.empty(shape, dtype = np.uint8)
+            tail, head = np.empty(shape, dtype = np.uint8), np.empty(shape, dtype = np.uint8)
+            for k in range(fade):
+                # copied one at a time, a compressed buffer reuses the frame it returns
+                np.copyto(tail[k], frames[end - fade + k])
+                np.copyto(head[k], frames[start + k])
+            crossfade(tail, head, self._blends)
+        return LoopSequence(frames, range(start + fade, end - fade), self._blends,
+            [(end - fade + k, start + k) for k in range(fade)])
+
+    @property
+    def playback_frames(self):
+        return self.buffer if self.clip is None else self.clip
+
+    @property
+    def playback_layout(self):
+        return self.frame_layout if self.clip is None else self.clip_layout
+
+    def set_clip(self, frames, layout: str = None):
+        if layout is None:
+            layout = self.frame_layout
+        if frames is not None and layout == YUYV and not all(o.writes_native for o in self.output_cameras):
+            raise ValueError("Clip is stored for the v4l2 output backend")
+        if frames is not None:
+            # buffered frames are scaled to the output size, whatever size the camera captures at
+            if layout == YUYV:
+                size = (frames.shape[2] // 2, frames.shape[1])
+            elif layout == COLUMN_MAJOR:
+                size = frames.shape[1:3]
+            else:
+                size = frames.shape[2:0:-1]
+            if tuple(size) != tuple(self.output_camera.size):
+                raise ValueError("Clip frame size does not match the output")
+
+        self._looping = False
+        self.clip, self.clip_layout = frames, layout
+
+    def save_clip(self, library, name: str):
+        # copies the buffer with gathering held off, so the capture thread cannot move the ring
+        # mid-copy; the slower write to disk happens after gathering resumes
+        with self._gather_mutex:
+            if not self.buffer.full:
+                raise ValueError("Loop buffer is not full yet")
+            frames = np.empty((len(self.buffer), ) + tuple(self.buffer[0].shape), dtype = np.uint8)
+            for i in range(len(frames)):
+                np.copyto(frames[i], self.buffer[i])
+        library.save(name, frames, self.frame_layout, self.fps)
+
+    def rescale(self, frame: np.ndarray) -> np.ndarray:
+        # the result is overwritten by the next call
+        if frame.shape == self.frame_shape:
+            return frame
+        if self._rescaler is None or self._rescaler.src_shape != frame.shape:
+            self._rescaler = Rescaler(frame.shape, self.frame_shape)
+        with metrics.time('rescale'):
+            return self._rescaler.resize(frame)
+
+    def set_quality(self, level):
+        # runs on the capture thread while not looping; frames gathered at the old rate would loop
+        # at the wrong speed, so the loop buffer starts over
+        logging.info("Switch to %dx%d at %g fps" % (level.size + (level.fps, )))
+        try:
+            if tuple(level.size) != tuple(self.input_camera.size or ()) or level.fps != self.fps:
+                self.input_camera.reopen(level.size, level.fps)
+        except (SystemError, ValueError, OSError) as e:
+            logging.error("Cannot switch the camera to %dx%d: %s" % (level.size + (e, )))
+            return
+
+        if level.fps != self.fps:
+            self.fps = level.fps
+            self.frame_delay = 1 / self.fps
+            for channel in self.channels:
+                channel.pacer.set_fps(self.fps)
+            buffer, self.buffer = self.buffer, self._make_buffer()
+            buffer.close()
+        else:
+            self.buffer.clear()
+            self.loop_points.clear()
+            if self.audio_loop is not None:
+                self.audio_loop.clear()
 
     def read_frames(self):
-        start_time = time.time()
-        frame = self.input_camera.read()
-        end_time = time.time()
-        yield frame, end_time - start_time
+        # frames come from self.pool, the caller releases them; yields each frame with the time spent
+        # processing it, not counting the wait for the camera
+        shape = self.input_camera.frame_shape
+        if shape != self.frame_shape or self.native:
+            frame = self.input_camera.read()
+            start_time = time.perf_counter()
+            if frame is not None:
+                frame = self.rescale(frame)
+            if frame is not None and self.native:
+                frame = self.output_camera.convert(frame, self.input_camera.layout,
+                    self.pool.acquire(self.output_camera.native_shape))
+            elif frame is not None:
+                out = self.pool.acquire(frame.shape)
+                np.copyto(out, frame)
+                frame = out
+        else:
+            out = self.pool.acquire(shape)
+            frame = self.input_camera.read(out)
+            start_time = time.perf_counter()
+            if frame is None:
+                self.pool.release(out)
+        if frame is not None:
+            self.pool.stamp(frame, start_time)
+        yield frame, time.perf_counter() - start_time
 
     def add_frame(self, frame):
         self.buffer.append(frame)
-        if len(self.buffer) > self.buffer_capacity:
-            del self.buffer[0] # TODO: replace with deque
+        if self.audio_loop is not None:
+            self.audio_loop.mark_frame()
+        with metrics.time('loop point'):
+            self.loop_points.add(frame)
 
-        logging.debug("Gather frame %d / %d" % (len(self.buffer), self.buffer_capacity))
+        logging.debug("Gather frame %d / %d" % (len(self.buffer), self.buffer.capacity))
 
-    def loop(self):
-        if self.is_looping:
-            frame_index = next(self._generator)
-            frame = self.buffer[frame_index]
-            self.output_camera.write(frame)
-            time.sleep(self.frame_delay)
-        else:
-            for frame, capture_delay in self.read_frames():
+    def start(self):
+        if self._capture_thread is not None:
+            return
+        self._capturing = True
+        self._capture_thread = threading.Thread(target = self.capture, daemon = True)
+        self._capture_thread.start()
+
+        for channel in self.channels[1:]:
+            channel.start()
+        if self.audio_loop is not None:
+            self.audio_loop.start()
+
+    def stop(self):
+        if self.audio_loop is not None:
+            self.audio_loop.stop()
+        for channel in self.channels[1:]:
+            channel.stop()
+
+        self._capturing = False
+        self._wake.set()
+        if self._capture_thread is not None:
+            self._capture_thread.join()
+            self._capture_thread = None
+
+        # the camera is handed back to whoever opened it, e.g. the preview, as it came in
+        if self._suspended:
+            try:
+                self.input_camera.resume()
+            except SystemError as e:
+                logging.error("Cannot resume capture: %s" % e)
+            self._suspended, self._resuming = False, False
+
+    def close(self):
+        self.stop()
+        self.buffer.close()
+
+    def capture(self):
+        # producer, runs on its own thread so a slow camera never stalls the outputs
+        while self._capturing:
+            if self.suspend_capture and not self._capture_needed():
+                if not self._suspended:
+                    self.input_camera.suspend()
+                    self._suspended = True
+                    logging.info("Suspended capture")
+                resume_at = self._resume_at
+                self._wake.wait(None if resume_at is None else max(0., resume_at - time.monotonic()))
+                self._wake.clear()
+                continue
+
+            if self._suspended:
+                try:
+                    with metrics.time('resume'):
+                        self.input_camera.resume()
+                except SystemError as e:
+                    logging.error("Cannot resume capture: %s" % e)
+                    time.sleep(self.frame_delay)
+                    continue
+                self._suspended = False
+                logging.info("Resumed capture")
+
+            if self.is_looping and not self.suspend_capture:
+                time.sleep(self.frame_delay)
+                continue
+
+            for frame, process_time in self.read_frames():
                 if frame is not None:
-                    self.output_camera.write(frame)
-                    if self.can_gather:
-                        self.add_frame(frame)
+                    start_time = time.perf_counter()
+                    self._resuming = False
+                    with self._gather_mutex:
+                        if self.can_gather and not self._looping:
+                            self.add_frame(frame)
+                    for channel in self.channels:
+                        channel.queue.put(frame)
+                    self.pool.release(frame)
+                    process_time += time.perf_counter() - start_time
+                    logging.debug("Capture %r %r" % (process_time, self.queue))
 
-                delay = max(0., self.frame_delay - capture_delay)
-                logging.debug("%r %r %r" % (delay, self.frame_delay, capture_delay))
-                time.sleep(delay)
+                if self.quality is not None and not self._looping:
+                    if frame is not None:
+                        self.quality.observe('capture', process_time)
+                    level = self.quality.update()
+                    if level is not None:
+                        with self._gather_mutex:
+                            if not self._looping:
+                                self.set_quality(level)
+
+    def loop(self):
+        # emits one frame per call to the first output at the target rate
+        self.start()
+        self.channels[0].step()
 
 
 if __name__ == "__main__":
     with RealCamera("/dev/video0") as input_cam:
         with OutputCamera() as output_cam:
-            VideoLooper(input_cam, output_cam).loop()
+            looper = VideoLooper(input_cam, output_cam)
+            try:
+                while True:
+                    looper.loop()
+            finally:
+                looper.close()
@@ -0,0 +1,102 @@
+import collections
+import json
+import logging
+import pathlib
+import string
+
+import numpy as np
+import xdg
+
+class ClipLibrary:
+    # each clip is a flat .npy array of frames (memory-mapped on load) with a .json sidecar
+    cache_bytes = 512 * 2**20
+
+    def __init__(self, path: pathlib.Path = None, cache_bytes: int = None):
+        if path is None:
+            path = ClipLibrary.get_default_path()
+        if cache_bytes is not None:
+            self.cache_bytes = cache_bytes
+
+        self.path = pathlib.Path(path)
+        self._cache = collections.OrderedDict() # name -> (frames, info), least recently used first
+        self._cached_bytes = 0
+
+    @staticmethod
+    def get_default_path() -> pathlib.Path:
+        return xdg.XDG_DATA_HOME / 'mmhZoom' / 'clips'
+
+    @staticmethod
+    def format_name(name: str) -> str:
+        name = name.strip()
+        if len(name) == 0:
+            raise ValueError("Clip name cannot be empty")
+        if not (set(name) <= set(string.ascii_letters + string.digits + " _-")):
+            raise ValueError("Incorrect clip name format")
+        return name
+
+    def _frames_path(self, name):
+        return self.path / (name + '.npy')
+
+    def _info_path(self, name):
+        return self.path / (name + '.json')
+
+    def list_clips(self):
+        if not self.path.is_dir():
+            return []
+        return sorted(p.stem for p in self.path.glob('*.npy') if self._info_path(p.stem).exists())
+
+    def save(self, name: str, frames, layout: str, fps: float):
+        name = ClipLibrary.format_name(name)
+        if len(frames) == 0:
+            raise ValueError("Cannot save an empty clip")
+        self.path.mkdir(parents = True, exist_ok = True)
+        self._evict(name)
+
+        first = frames[0]
+        out = np.lib.format.open_memmap(self._frames_path(name), mode = 'w+',
+            dtype = first.dtype, shape = (len(frames), ) + first.shape)
+        for i in range(len(frames)):
+            out[i] = frames[i]
+        out.flush()
+        del out
+
+        with open(self._info_path(name), "w") as f:
+            json.dump({'layout': layout, 'fps': fps}, f)
+
+        logging.info("Saved clip %r (%d frames)" % (name, len(frames)))
+
+    def load(self, name: str):
+        # returns (frames, info); frames are paged in from disk on access
+        name = ClipLibrary.format_name(name)
+        if name in self._cache:
+            self._cache.move_to_end(name)
+            return self._cache[name]
+
+        with open(self._info_path(name), "r") as f:
+            info = json.load(f)
+        frames = np.load(self._frames_path(name), mmap_mode = 'r')
+
+        self._cache[name] = (frames, info)
+        self._cached_bytes += frames.nbytes
+        while self._cached_bytes > self.cache_bytes and len(self._cache) > 1:
+            self._evict(next(iter(self._cache)))
+        return frames, info
+
+    def remove(self, name: str):
+        name = ClipLibrary.format_name(name)
+        self._evict(name)
+        for path in (self._frames_path(name), self._info_path(name)):
+            if path.exists():
+                path.unlink()
+
+    def _evict(self, name):
+        entry = self._cache.pop(name, None)
+        if entry is not None:
+            self._cached_bytes -= entry[0].nbytes
+
+    @property
+    def cached_bytes(self):
+        return self._cached_bytes
+
+    def __repr__(self):
+        return "ClipLibrary<%s, %d cached>" % (self.path, len(self._cache))
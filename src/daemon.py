@@ -0,0 +1,375 @@
+import argparse
+import json
+import logging
+import os
+import pathlib
+import socket
+import socketserver
+import sys
+import threading
+
+import xdg
+
+from meeting import Meeting, MeetingList
+from meeting_join import MeetingScheduler
+from metrics import metrics
+
+# headless mmhZoom: runs the video looper and the meeting auto-joiner without Qt, controlled over a
+# Unix socket with one JSON request and one JSON reply per line, e.g.
+#   python3 src/daemon.py serve &
+#   python3 src/daemon.py video start
+#   python3 src/daemon.py loop on
+
+def get_default_socket_path() -> pathlib.Path:
+    runtime_dir = xdg.XDG_RUNTIME_DIR
+    if runtime_dir is None:
+        return pathlib.Path('/tmp') / ('mmhZoom-%d.sock' % os.getuid())
+    return runtime_dir / 'mmhZoom.sock'
+
+class Daemon:
+    # the video tab and meeting tab of the GUI, without widgets
+    # pygame and alsaaudio are only loaded once video or the microphone is used
+
+    def __init__(self, meetings_path: pathlib.Path = None, suspend_capture: bool = False,
+            audio_loop_device: str = None, output_backend: str = 'v4l2'):
+        self.suspend_capture = suspend_capture
+        self.audio_loop_device = audio_loop_device
+        self.output_backend = output_backend # camera.OutputCamera.BACKENDS, camera is loaded with video
+        self._mutex = threading.RLock()
+        self._stopped = False
+        self._wake = threading.Event() # set when the meetings change or the daemon stops
+
+        self.looper = None
+        self.input_cam, self.output_cams = None, []
+        self._video_thread = None
+        self._video_running = False
+        self._audio = None
+
+        self.meetings_path = meetings_path
+        self.model = MeetingList.load_from_file(meetings_path)
+        self.scheduler = MeetingScheduler(self.model.get_meetings())
+        self._auto_join_thread = threading.Thread(target = self._run_auto_join, daemon = True)
+
+        self.commands = {
+            'video.start': self.start_video,
+            'video.stop': self.stop_video,
+            'loop': self.set_looping,
+            'speak': self.set_capture,
+            'prepare': self.prepare_live,
+            'meeting.list': self.list_meetings,
+            'meeting.add': self.add_meeting,
+            'meeting.edit': self.edit_meeting,
+            'meeting.remove': self.remove_meeting,
+            'status': self.status,
+            'metrics': self.get_metrics,
+        }
+
+    def start(self):
+        self._auto_join_thread.start()
+        return self
+
+    def _run_auto_join(self):
+        # sleeps until the next meeting is due, or indefinitely while none is scheduled
+        while not self._stopped:
+            with self._mutex:
+                delay = self.scheduler.next_delay()
+            self._wake.wait(delay)
+            self._wake.clear()
+            with self._mutex:
+                self.scheduler.process()
+
+    @property
+    def audio(self):
+        if self._audio is None:
+            import audio
+            self._audio = audio.AudioController()
+            self._audio.add_listener(self.capture_changed)
+        return self._audio
+
+    def capture_changed(self, value: bool):
+        logging.info("Microphone %s" % ("on" if value else "off"))
+
+    def handle(self, request: dict):
+        command = self.commands.get(request.get('command'))
+        if command is None:
+            raise ValueError("Unknown command %r" % request.get('command'))
+        with self._mutex:
+            return command(**request.get('args', {}))
+
+    # video
+
+    def start_video(self, input_device: str = None, output_devices = None):
+        if self.looper is not None:
+            raise ValueError("Video is already running")
+        import camera
+
+        if input_device is None:
+            input_device = camera.RealCamera.get_default_device()
+        if not output_devices:
+            output_devices = [camera.OutputCamera.get_default_device()]
+        if input_device in output_devices:
+            raise ValueError("Input and output device are the same")
+
+        metrics.reset()
+        try:
+            self.input_cam = camera.open_input_camera(input_device, layout = camera.ROW_MAJOR)
+            for device in output_devices:
+                self.output_cams.append(camera.OutputCamera(device, backend = self.output_backend).init())
+            audio_loop = None
+            if self.audio_loop_device:
+                import audio_loop as audio_loop_module
+                audio_loop = audio_loop_module.AudioLoop(playback_device = self.audio_loop_device)
+            self.looper = camera.VideoLooper(self.input_cam, self.output_cams, suspend_capture = self.suspend_capture,
+                audio_loop = audio_loop)
+            if audio_loop is not None:
+                audio_loop.open()
+        except Exception:
+            self._release_video()
+            raise
+
+        self._video_running = True
+        self._video_thread = threading.Thread(target = self._run_video, daemon = True)
+        self._video_thread.start()
+        logging.info("Video from %s to %s" % (input_device, ", ".join(output_devices)))
+        return self.status()
+
+    def _run_video(self):
+        while self._video_running:
+            self.looper.loop()
+
+    def stop_video(self):
+        if self.looper is None:
+            raise ValueError("Video is not running")
+        self._video_running = False
+        self._video_thread.join()
+        self._video_thread = None
+        self._release_video()
+        return self.status()
+
+    def _release_video(self):
+        if self.looper is not None:
+            self.looper.close()
+            self.looper = None
+        if self.input_cam is not None:
+            self.input_cam.release()
+            self.input_cam = None
+        for output_cam in self.output_cams:
+            output_cam.release()
+        self.output_cams = []
+
+    def set_looping(self, value: bool):
+        # looping mutes the microphone, like the Loop button
+        if self.looper is None:
+            raise ValueError("Video is not running")
+        if value and not self.looper.can_loop:
+            raise ValueError("Loop buffer is not full yet")
+        if value:
+            self.audio.set_capture(False)
+        self.looper.is_looping = value
+        return self.status()
+
+    def prepare_live(self, seconds: float):
+        # warms up a suspended camera so live video is ready in the given number of seconds
+        if self.looper is None:
+            raise ValueError("Video is not running")
+        self.looper.prepare_live(seconds)
+        return self.status()
+
+    def set_capture(self, value: bool):
+        # speaking stops the loop, like the Speak button
+        self.audio.set_capture(value)
+        if value and self.looper is not None:
+            self.looper.is_looping = False
+        return self.status()
+
+    # meetings
+
+    def list_meetings(self):
+        return [dict(zip(('meeting_id', 'password', 'name', 'datetime'), meeting)) for meeting in self.model.get_meetings()]
+
+    def add_meeting(self, meeting_id: str, datetime: str, password: str = '', name: str = ''):
+        meeting = Meeting(meeting_id, password, name, datetime)
+        self.model.add_meeting(meeting)
+        self.model.save(self.meetings_path)
+        self.scheduler.add(meeting)
+        self._wake.set()
+        return self.list_meetings()
+
+    def edit_meeting(self, index: int, **fields):
+        old_meeting = self.model.get_index(index)
+        old = dict(zip(('meeting_id', 'password', 'name', 'datetime'), old_meeting))
+        old.update(fields)
+        meeting = Meeting(old['meeting_id'], old['password'], old['name'], old['datetime'])
+        self.model.replace_index(index, meeting)
+        self.model.save(self.meetings_path)
+        self.scheduler.replace(old_meeting, meeting)
+        self._wake.set()
+        return self.list_meetings()
+
+    def remove_meeting(self, index: int):
+        self.scheduler.remove(self.model.get_index(index))
+        self.model.remove_index(index)
+        self.model.save(self.meetings_path)
+        self._wake.set()
+        return self.list_meetings()
+
+    # status
+
+    def status(self):
+        looper = self.looper
+        return {
+            'video': looper is not None,
+            'input': getattr(self.input_cam, 'device_id', None),
+            'outputs': [o.device_id for o in self.output_cams],
+            'can_loop': looper is not None and looper.can_loop,
+            'looping': looper is not None and looper.is_looping,
+            'capture_suspended': looper is not None and looper.capture_suspended,
+            'audio_loop': looper is not None and looper.audio_loop is not None,
+            'speaking': self._audio is not None and self._audio.is_capturing(),
+            'meetings': len(self.model.get_meetings()),
+            'metrics': metrics.summary() if looper is not None else '',
+        }
+
+    def get_metrics(self):
+        return metrics.snapshot()
+
+    def close(self):
+        self._stopped = True
+        self._wake.set()
+        with self._mutex:
+            if self.looper is not None:
+                self.stop_video()
+            if self._audio is not None:
+                self._audio.close()
+
+
+class ControlHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            try:
+                reply = {'ok': True, 'result': self.server.service.handle(json.loads(line))}
+            except Exception as e:
+                logging.info("Request failed: %r" % e)
+                reply = {'ok': False, 'error': str(e) or type(e).__name__}
+            self.wfile.write(json.dumps(reply).encode() + b'\n')
+
+class ControlServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path: pathlib.Path, service: Daemon):
+        self.service = service
+        path = pathlib.Path(path)
+        if path.exists():
+            path.unlink() # left behind by a daemon that did not exit cleanly
+        old_umask = os.umask(0o177) # only the owner may connect
+        try:
+            super(ControlServer, self).__init__(str(path), ControlHandler)
+        finally:
+            os.umask(old_umask)
+        self.path = path
+
+    def server_close(self):
+        super(ControlServer, self).server_close()
+        if self.path.exists():
+            self.path.unlink()
+
+
+def request(path: pathlib.Path, command: str, **args):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(str(path))
+        sock.sendall(json.dumps({'command': command, 'args': args}).encode() + b'\n')
+        reply = json.loads(sock.makefile().readline())
+    if not reply['ok']:
+        raise RuntimeError(reply['error'])
+    return reply['result']
+
+def serve(path: pathlib.Path, suspend_capture: bool = False, audio_loop_device: str = None,
+        output_backend: str = 'v4l2'):
+    daemon = Daemon(suspend_capture = suspend_capture, audio_loop_device = audio_loop_device,
+        output_backend = output_backend).start()
+    with ControlServer(path, daemon) as server:
+        logging.info("Listening on %s" % path)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            daemon.close()
+
+def parse_on_off(text: str) -> bool:
+    if text not in ('on', 'off'):
+        raise argparse.ArgumentTypeError("expected on or off")
+    return text == 'on'
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = "Headless mmhZoom")
+    parser.add_argument('--socket', type = pathlib.Path, default = get_default_socket_path())
+    parser.add_argument('--verbose', '-v', action = 'store_true')
+    subparsers = parser.add_subparsers(dest = 'action', required = True)
+
+    serve_parser = subparsers.add_parser('serve', help = "run the daemon")
+    serve_parser.add_argument('--suspend-capture', action = 'store_true', help = "stop the camera while looping")
+    serve_parser.add_argument('--audio-loop', dest = 'audio_loop_device', metavar = 'DEVICE',
+        help = "record room audio with the loop and play it to this sound device, e.g. hw:Loopback,0")
+    serve_parser.add_argument('--backend', dest = 'output_backend', choices = ['v4l2', 'pyfakewebcam'], default = 'v4l2',
+        help = "how frames are written to the loopback device")
+
+    video_parser = subparsers.add_parser('video', help = "start or stop the fake webcam")
+    video_parser.add_argument('state', choices = ['start', 'stop'])
+    video_parser.add_argument('--input', dest = 'input_device')
+    video_parser.add_argument('--output', dest = 'output_devices', action = 'append')
+
+    subparsers.add_parser('loop').add_argument('value', type = parse_on_off)
+    subparsers.add_parser('speak').add_argument('value', type = parse_on_off)
+    subparsers.add_parser('prepare', help = "warm up a suspended camera for live video in SECONDS"
+        ).add_argument('seconds', type = float)
+
+    meeting_parser = subparsers.add_parser('meeting', help = "list, add, edit or remove meetings")
+    meeting_subparsers = meeting_parser.add_subparsers(dest = 'meeting_action', required = True)
+    meeting_subparsers.add_parser('list')
+    for action in ('add', 'edit'):
+        action_parser = meeting_subparsers.add_parser(action)
+        if action == 'edit':
+            action_parser.add_argument('index', type = int)
+        action_parser.add_argument('--id', dest = 'meeting_id', required = action == 'add')
+        action_parser.add_argument('--password')
+        action_parser.add_argument('--name')
+        action_parser.add_argument('--time', dest = 'datetime', required = action == 'add',
+            help = "ISO date and time, e.g. 2020-09-01T10:00")
+    meeting_subparsers.add_parser('remove').add_argument('index', type = int)
+
+    subparsers.add_parser('status')
+    subparsers.add_parser('metrics')
+
+    args = parser.parse_args(argv)
+    logging.basicConfig(level = logging.INFO if args.verbose else logging.WARN)
+
+    if args.action == 'serve':
+        serve(args.socket, args.suspend_capture, args.audio_loop_device, args.output_backend)
+        return
+
+    if args.action == 'video':
+        if args.state == 'start':
+            command, fields = 'video.start', {'input_device': args.input_device, 'output_devices': args.output_devices}
+        else:
+            command, fields = 'video.stop', {}
+    elif args.action in ('loop', 'speak'):
+        command, fields = args.action, {'value': args.value}
+    elif args.action == 'prepare':
+        command, fields = 'prepare', {'seconds': args.seconds}
+    elif args.action == 'meeting':
+        command = 'meeting.' + args.meeting_action
+        fields = {k: v for k, v in vars(args).items()
+            if k in ('index', 'meeting_id', 'password', 'name', 'datetime') and v is not None}
+    else:
+        command, fields = args.action, {}
+
+    try:
+        result = request(args.socket, command, **fields)
+    except (OSError, RuntimeError) as e:
+        print("Error: %s" % e, file = sys.stderr)
+        sys.exit(1)
+    print(json.dumps(result, indent = 1))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+import ctypes
+import fcntl
+import logging
+import os
+import pathlib
+import threading
+
+import pyfakewebcam.v4l2 as v4l2
+
+LOOPBACK_DRIVER = 'v4l2 loopback'
+
+V4L2_CAP_VIDEO_CAPTURE = 0x00000001
+V4L2_CAP_VIDEO_OUTPUT = 0x00000002
+V4L2_CAP_DEVICE_CAPS = 0x80000000
+
+class v4l2_capability(ctypes.Structure):
+    # pyfakewebcam's definition predates device_caps, which tells a camera's capture node from its metadata node
+    _fields_ = [
+        ('driver', ctypes.c_char * 16),
+        ('card', ctypes.c_char * 32),
+        ('bus_info', ctypes.c_char * 32),
+        ('version', ctypes.c_uint32),
+        ('capabilities', ctypes.c_uint32),
+        ('device_caps', ctypes.c_uint32),
+        ('reserved', ctypes.c_uint32 * 3),
+    ]
+
+VIDIOC_QUERYCAP = v4l2._IOR('V', 0, v4l2_capability)
+
+class VideoDevice:
+    def __init__(self, path: str, name: str, driver: str, caps: int):
+        self.path = path
+        self.name = name
+        self.driver = driver
+        self.caps = caps
+
+    @property
+    def is_loopback(self):
+        return self.driver == LOOPBACK_DRIVER
+
+    @property
+    def can_capture(self):
+        return bool(self.caps & V4L2_CAP_VIDEO_CAPTURE)
+
+    @property
+    def can_output(self):
+        return bool(self.caps & V4L2_CAP_VIDEO_OUTPUT)
+
+    def __repr__(self):
+        return "VideoDevice(%r, %r, %r)" % (self.path, self.name, self.driver)
+
+
+class DeviceRegistry:
+    # video4linux nodes listed from sysfs; each node is probed once, when it first appears
+    sysfs_path = pathlib.Path('/sys/class/video4linux')
+    dev_path = pathlib.Path('/dev')
+
+    def __init__(self):
+        self._mutex = threading.Lock()
+        self._refresh_mutex = threading.Lock()
+        self._devices = {}
+        self.scanned = False
+
+    @staticmethod
+    def _node_key(node: str):
+        digits = node[len('video'):]
+        return (int(digits) if digits.isdigit() else 0, node)
+
+    def probe(self, node: str) -> VideoDevice:
+        path = str(self.dev_path / node)
+        try:
+            name = (self.sysfs_path / node / 'name').read_text().strip()
+        except OSError:
+            name = node
+
+        capability = v4l2_capability()
+        try:
+            fd = os.open(path, os.O_RDONLY | os.O_NONBLOCK)
+            try:
+                fcntl.ioctl(fd, VIDIOC_QUERYCAP, capability)
+            finally:
+                os.close(fd)
+        except OSError as e:
+            logging.info("Cannot probe %s: %s" % (path, e))
+            return None
+
+        caps = capability.device_caps if capability.capabilities & V4L2_CAP_DEVICE_CAPS else capability.capabilities
+        return VideoDevice(path, name, capability.driver.decode(errors = 'replace'), caps)
+
+    def refresh(self):
+        # returns the (added, removed) device paths
+        with self._refresh_mutex:
+            return self._refresh()
+
+    def _refresh(self):
+        try:
+            nodes = set(p.name for p in self.sysfs_path.iterdir() if p.name.startswith('video'))
+        except OSError:
+            nodes = set()
+
+        with self._mutex:
+            known = set(self._devices)
+        new_devices = {node: self.probe(node) for node in nodes - known}
+
+        with self._mutex:
+            removed = []
+            for node in known - nodes:
+                device = self._devices.pop(node)
+                if device:
+                    removed.append(device.path)
+            self._devices.update(new_devices)
+            self.scanned = True
+        added = [device.path for device in new_devices.values() if device]
+
+        if added or removed:
+            logging.info("Video devices added %r, removed %r" % (added, removed))
+        return added, removed
+
+    def get_devices(self):
+        if not self.scanned:
+            self.refresh()
+        with self._mutex:
+            nodes = sorted(self._devices, key = DeviceRegistry._node_key)
+            return [self._devices[node] for node in nodes if self._devices[node]]
+
+    def get_capture_devices(self):
+        return [d.path for d in self.get_devices() if d.can_capture and not d.is_loopback]
+
+    def get_loopback_devices(self):
+        return [d.path for d in self.get_devices() if d.is_loopback]
+
+    def __repr__(self):
+        return "DeviceRegistry<%d devices>" % len(self._devices)
+
+registry = DeviceRegistry()
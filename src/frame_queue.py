@@ -0,0 +1,138 @@
+import collections
+import threading
+
+import numpy as np
+
+class FramePool:
+    # reference-counted frame buffers shared by the queues of every output
+    # a buffer goes back to the pool once the producer and all queues holding it have released it
+    def __init__(self):
+        self._mutex = threading.Lock()
+        self._free = []
+        self._refs = {}
+        self._times = {} # capture time of frames handed out, see stamp()
+        self._shape = None
+
+    def acquire(self, shape, dtype = np.uint8) -> np.ndarray:
+        # the caller holds the first reference and must release() it
+        with self._mutex:
+            shape = tuple(shape)
+            if self._shape != shape:
+                self._shape = shape
+                self._free = []
+            frame = self._free.pop() if self._free else np.empty(shape, dtype = dtype)
+            self._refs[id(frame)] = 1
+            return frame
+
+    def retain(self, frame: np.ndarray):
+        with self._mutex:
+            self._refs[id(frame)] += 1
+
+    def release(self, frame: np.ndarray):
+        with self._mutex:
+            refs = self._refs[id(frame)] - 1
+            if refs > 0:
+                self._refs[id(frame)] = refs
+                return
+            del self._refs[id(frame)]
+            self._times.pop(id(frame), None)
+            if frame.shape == self._shape:
+                self._free.append(frame)
+
+    def stamp(self, frame: np.ndarray, capture_time: float):
+        # when the frame was captured, kept until the frame goes back to the pool
+        with self._mutex:
+            self._times[id(frame)] = capture_time
+
+    def captured_at(self, frame: np.ndarray) -> float:
+        return self._times.get(id(frame))
+
+    def __len__(self):
+        return len(self._free) + len(self._refs)
+
+
+class FrameQueue:
+    # bounded single-consumer frame queue; when full the oldest frame is dropped
+    # the consumer's frame from get() stays untouched until its next get()
+    def __init__(self, maxlen: int = 2, pool: FramePool = None):
+        self.maxlen = maxlen
+        self.pool = FramePool() if pool is None else pool
+        self._cond = threading.Condition()
+        self._queue = collections.deque()
+        self._held = None
+
+        self.dropped = 0
+        self.duplicated = 0
+
+    def acquire(self, shape, dtype = np.uint8) -> np.ndarray:
+        return self.pool.acquire(shape, dtype)
+
+    def put(self, frame: np.ndarray):
+        self.pool.retain(frame)
+        with self._cond:
+            if len(self._queue) >= self.maxlen:
+                self.pool.release(self._queue.popleft())
+                self.dropped += 1
+            self._queue.append(frame)
+            self._cond.notify()
+
+    def get(self, timeout: float = None) -> np.ndarray:
+        # returns the next frame, or repeats the previous one if none arrived within timeout
+        with self._cond:
+            if len(self._queue) == 0 and timeout:
+                self._cond.wait(timeout)
+
+            if len(self._queue) == 0:
+                if self._held is not None:
+                    self.duplicated += 1
+                return self._held
+
+            if self._held is not None:
+                self.pool.release(self._held)
+            self._held = self._queue.popleft()
+            return self._held
+
+    def clear(self):
+        with self._cond:
+            for frame in self._queue:
+                self.pool.release(frame)
+            self._queue.clear()
+
+    def __len__(self):
+        return len(self._queue)
+
+    def __repr__(self):
+        return "FrameQueue<%d / %d, %d dropped, %d duplicated>" % (
+            len(self._queue), self.maxlen, self.dropped, self.duplicated)
+
+
+class FrameSlot:
+    # latest frame with a sequence number, handed over without locks
+    # writers never touch a published frame until the next one is published, so a reader
+    # may use the frame in place and afterwards check valid(seq) to know it was not overwritten
+    def __init__(self):
+        self._state = (0, None)
+
+    def publish(self, frame: np.ndarray):
+        self._state = (self._state[0] + 1, frame)
+
+    @property
+    def seq(self) -> int:
+        return self._state[0]
+
+    @property
+    def frame(self) -> np.ndarray:
+        return self._state[1]
+
+    def read(self, since: int = None):
+        # returns (seq, frame), frame is None when nothing new was published since the given seq
+        seq, frame = self._state
+        if since is not None and since == seq:
+            return seq, None
+        return seq, frame
+
+    def valid(self, seq: int) -> bool:
+        return self._state[0] == seq
+
+    def __repr__(self):
+        return "FrameSlot<#%d>" % self.seq
@@ -0,0 +1,552 @@
+import io
+import logging
+import threading
+
+import numpy as np
+
+pygame = None # imported by JpegCodec
+
+class FrameRingBuffer:
+    # frames live in one contiguous (capacity, *frame_shape) array, allocated on the first frame
+    def __init__(self, capacity: int, max_bytes: int = None):
+        self.requested_capacity = capacity
+        self.capacity = capacity
+        self.max_bytes = max_bytes
+        self.frames = None
+        self.count = 0
+        self.index = 0 # next slot to be written
+
+    def allocate(self, shape, dtype = np.uint8):
+        self.capacity = self.requested_capacity
+        if self.max_bytes is not None:
+            frame_bytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+            self.capacity = max(1, min(self.capacity, self.max_bytes // frame_bytes))
+
+        self.frames = np.empty((self.capacity, ) + tuple(shape), dtype = dtype)
+        self.clear()
+
+    def clear(self):
+        self.count = 0
+        self.index = 0
+
+    def next_slot(self, shape = None, dtype = np.uint8) -> np.ndarray:
+        if shape is not None and (self.frames is None or self.frames.shape[1:] != tuple(shape)):
+            self.allocate(shape, dtype)
+        return self.frames[self.index]
+
+    def commit(self):
+        self.index = (self.index + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+
+    def append(self, frame: np.ndarray):
+        np.copyto(self.next_slot(frame.shape, frame.dtype), frame)
+        self.commit()
+
+    def slot_of(self, i: int) -> int:
+        # i = 0 is the oldest frame held
+        if not 0 <= i < self.count:
+            raise IndexError("frame index out of range")
+        return (self.index - self.count + i) % self.capacity
+
+    def __getitem__(self, i: int) -> np.ndarray:
+        return self.frames[self.slot_of(i)]
+
+    def set_playlist(self, playlist):
+        pass # frames are not decoded, so the playback order does not matter
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def full(self):
+        return self.count >= self.capacity
+
+    @property
+    def nbytes(self):
+        return 0 if self.frames is None else self.frames.nbytes
+
+    def close(self):
+        pass
+
+    def __repr__(self):
+        return "FrameRingBuffer<%d / %d>" % (self.count, self.capacity)
+
+
+class Yuv420Codec:
+    # full-range YCbCr with 2x2 chroma subsampling, 12 bits per pixel instead of 24
+    # planes are subsampled along the first two axes, so either frame layout works
+    name = 'yuv420'
+
+    _rgb2yuv = np.array([[0.299, 0.587, 0.114],
+                         [-0.168736, -0.331264, 0.5],
+                         [0.5, -0.418688, -0.081312]], dtype = np.float32)
+    _yuv2rgb = np.array([[1.0, 0.0, 1.402],
+                         [1.0, -0.344136, -0.714136],
+                         [1.0, 1.772, 0.0]], dtype = np.float32)
+
+    def __init__(self):
+        self._encode_scratch = None
+        self._decode_scratch = None
+
+    @staticmethod
+    def encoded_size(shape):
+        a, b = shape[0], shape[1]
+        return a * b + 2 * (a // 2) * (b // 2)
+
+    def _planes(self, data: np.ndarray, shape):
+        a, b = shape[0], shape[1]
+        n, m = a * b, (a // 2) * (b // 2)
+        return (data[:n].reshape(a, b),
+                data[n:n + m].reshape(a // 2, b // 2),
+                data[n + m:n + 2 * m].reshape(a // 2, b // 2))
+
+    def encode(self, frame: np.ndarray, out: np.ndarray = None) -> np.ndarray:
+        if out is None:
+            out = np.empty(self.encoded_size(frame.shape), dtype = np.uint8)
+        if self._encode_scratch is None or self._encode_scratch.shape != frame.shape:
+            self._encode_scratch = np.empty(frame.shape, dtype = np.float32)
+
+        a, b = (frame.shape[0] // 2) * 2, (frame.shape[1] // 2) * 2
+        yuv = self._encode_scratch
+        np.matmul(frame, self._rgb2yuv.T, out = yuv)
+        y, u, v = self._planes(out, frame.shape)
+        np.clip(yuv[:, :, 0], 0, 255, out = yuv[:, :, 0])
+        y[...] = yuv[:, :, 0]
+        for plane, channel in ((u, 1), (v, 2)):
+            c = yuv[:a, :b, channel]
+            # average each 2x2 block in place in the top-left sample
+            c[0::2, 0::2] += c[1::2, 0::2]
+            c[0::2, 0::2] += c[0::2, 1::2]
+            c[0::2, 0::2] += c[1::2, 1::2]
+            c[0::2, 0::2] *= 0.25
+            c[0::2, 0::2] += 128
+            np.clip(c[0::2, 0::2], 0, 255, out = c[0::2, 0::2])
+            plane[...] = c[0::2, 0::2]
+        return out
+
+    def decode(self, data: np.ndarray, shape, out: np.ndarray = None) -> np.ndarray:
+        if out is None:
+            out = np.empty(shape, dtype = np.uint8)
+        if self._decode_scratch is None or self._decode_scratch.shape != tuple(shape):
+            self._decode_scratch = np.empty(shape, dtype = np.float32)
+
+        a, b = (shape[0] // 2) * 2, (shape[1] // 2) * 2
+        yuv = self._decode_scratch
+        y, u, v = self._planes(data, shape)
+        yuv[:, :, 0] = y
+        for plane, channel in ((u, 1), (v, 2)):
+            for i in (0, 1):
+                for j in (0, 1):
+                    yuv[i:a:2, j:b:2, channel] = plane
+            yuv[:, :, channel] -= 128
+        np.matmul(yuv, self._yuv2rgb.T, out = yuv)
+        np.clip(yuv, 0, 255, out = yuv)
+        np.copyto(out, yuv, casting = 'unsafe')
+        return out
+
+
+class JpegCodec:
+    # per-frame JPEG through pygame's image module, variable size
+    name = 'jpeg'
+
+    def __init__(self, row_major: bool = False):
+        global pygame
+        import pygame # only needed with jpeg compression, and slow to import
+        self.row_major = row_major
+        self._surface = None
+
+    def _surface_view(self, frame: np.ndarray) -> np.ndarray:
+        # pygame surfaces are addressed (x, y)
+        return frame.transpose((1,0,2)) if self.row_major else frame
+
+    def encode(self, frame: np.ndarray) -> bytes:
+        pixels = self._surface_view(frame)
+        size = pixels.shape[:2]
+        if self._surface is None or self._surface.get_size() != size:
+            self._surface = pygame.Surface(size, 0, 24)
+        pygame.surfarray.blit_array(self._surface, pixels)
+
+        f = io.BytesIO()
+        pygame.image.save(self._surface, f, 'frame.jpg')
+        return f.getvalue()
+
+    def decode(self, data: bytes, shape, out: np.ndarray = None) -> np.ndarray:
+        if out is None:
+            out = np.empty(shape, dtype = np.uint8)
+        surface = pygame.image.load(io.BytesIO(data), 'frame.jpg')
+        pixels = pygame.surfarray.pixels3d(surface)
+        np.copyto(self._surface_view(out), pixels)
+        del pixels
+        return out
+
+
+class CompressedFrameBuffer:
+    # ring of encoded frames; frames are decoded ahead of playback on a background thread
+    prefetch_depth = 4
+
+    def __init__(self, capacity: int, codec, max_bytes: int = None):
+        self.requested_capacity = capacity
+        self.capacity = capacity
+        self.codec = codec
+        self.max_bytes = max_bytes
+        self.shape = None
+        self.fixed_size = hasattr(codec, 'encoded_size')
+
+        self.storage = None # fixed-size codecs encode into one preallocated array
+        self.items = [None] * capacity
+        self._item_bytes = 0
+        self._limited = False
+        self.count = 0
+        self.index = 0
+
+        self._cond = threading.Condition()
+        self._decode_lock = threading.Lock()
+        self._decoded = {}
+        self._free = []
+        self._current = None
+        self._want = None # position of the next frame played, in the playlist when one is set
+        self._playlist = None # frame indices in playing order; a frame may come up more than once
+        self._generation = 0
+        self._thread = None
+        self._running = False
+
+    def allocate(self, shape, dtype = np.uint8):
+        self.shape = tuple(shape)
+        self.capacity = self.requested_capacity
+        if self.fixed_size:
+            frame_bytes = self.codec.encoded_size(self.shape)
+            if self.max_bytes is not None:
+                self.capacity = max(1, min(self.capacity, self.max_bytes // frame_bytes))
+            self.storage = np.empty((self.capacity, frame_bytes), dtype = np.uint8)
+
+        self.items = [None] * self.capacity
+        with self._cond:
+            self._free = [np.empty(self.shape, dtype = np.uint8) for i in range(self.prefetch_depth + 2)]
+            self._decoded = {}
+            self._current = None
+        self.clear()
+
+    def clear(self):
+        self.count = 0
+        self.index = 0
+        self._item_bytes = 0
+        self._limited = False
+        self._invalidate() # the playlist stays until the next one, outputs may still be playing it
+
+    def append(self, frame: np.ndarray):
+        if self.shape != frame.shape:
+            self.allocate(frame.shape)
+
+        if self.fixed_size:
+            self.codec.encode(frame, self.storage[self.index])
+            self.items[self.index] = self.storage[self.index]
+        else:
+            if self.items[self.index] is not None and self.count == self.capacity:
+                self._item_bytes -= len(self.items[self.index])
+            item = self.codec.encode(frame)
+            self.items[self.index] = item
+            self._item_bytes += len(item)
+
+        self.index = (self.index + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+
+        if self.max_bytes is not None and not self.fixed_size:
+            while self._item_bytes > self.max_bytes and self.count > 1:
+                self._drop_oldest()
+
+        self._invalidate()
+
+    def _drop_oldest(self):
+        slot = (self.index - self.count) % self.capacity
+        self._item_bytes -= len(self.items[slot])
+        self.items[slot] = None
+        self.count -= 1
+        self._limited = True
+
+    def slot_of(self, i: int) -> int:
+        if not 0 <= i < self.count:
+            raise IndexError("frame index out of range")
+        return (self.index - self.count + i) % self.capacity
+
+    def decode(self, i: int, out: np.ndarray = None) -> np.ndarray:
+        with self._decode_lock:
+            return self.codec.decode(self.items[self.slot_of(i)], self.shape, out)
+
+    def _invalidate(self):
+        with self._cond:
+            self._free.extend(self._decoded.values())
+            self._decoded = {}
+            self._want = None
+            self._generation += 1
+
+    def set_playlist(self, playlist):
+        # prefetch along the order frames are played in, read them with play(position)
+        with self._cond:
+            self._playlist = list(playlist) or None
+            # a decode running now checks its generation, the window moves to the start of the playlist
+            self._want = 0 if self._playlist and self.count else None
+            self._generation += 1
+            self._cond.notify()
+
+    def _window(self, position):
+        # frame indices played from position on
+        playlist = self._playlist
+        n = len(playlist) if playlist else self.count
+        window = [(position + k) % n for k in range(min(self.prefetch_depth, n))]
+        return [playlist[p] for p in window] if playlist else window
+
+    def __getitem__(self, i: int) -> np.ndarray:
+        # frames read by index are prefetched in index order unless a playlist is set
+        return self._get(i, None if self._playlist else i + 1)
+
+    def play(self, position: int) -> np.ndarray:
+        # the frame at a position of the playlist; prefetching goes on from the next position
+        return self._get(self._playlist[position], position + 1)
+
+    def _get(self, i: int, want: int) -> np.ndarray:
+        self._start_prefetch()
+        with self._cond:
+            if self._current is not None:
+                self._free.append(self._current)
+            frame = self._decoded.pop(i, None)
+            hit = frame is not None
+            if not hit:
+                frame = self._free.pop()
+            self._current = frame # held until the next call, the caller is writing it out
+
+            if want is not None:
+                self._want = want
+            window = [] if self._want is None else self._window(self._want)
+            for k in [k for k in self._decoded if k not in window]:
+                self._free.append(self._decoded.pop(k))
+            self._cond.notify()
+
+        if not hit:
+            self.decode(i, frame) # prefetch miss, decode on the calling thread
+        return frame
+
+    def _start_prefetch(self):
+        if self._thread is not None:
+            return
+        self._running = True
+        self._thread = threading.Thread(target = self._prefetch, daemon = True)
+        self._thread.start()
+
+    def _prefetch(self):
+        try:
+            self._prefetch_frames()
+        except Exception:
+            # reported, and started again by the next read rather than leaving every frame to the caller
+            logging.exception("Frame prefetch failed")
+            with self._cond:
+                self._thread = None
+
+    def _prefetch_frames(self):
+        while True:
+            with self._cond:
+                while self._running and self._next_prefetch() is None:
+                    self._cond.wait()
+                if not self._running:
+                    return
+                i = self._next_prefetch()
+                out = self._free.pop()
+                generation = self._generation
+
+            try:
+                self.decode(i, out)
+                decoded = True
+            except IndexError:
+                decoded = False
+            except Exception:
+                logging.exception("Cannot decode frame %d" % i)
+                decoded = False # the caller decodes it again and gets the error itself
+
+            with self._cond:
+                if out.shape != self.shape:
+                    continue # buffer was reallocated meanwhile
+                if decoded and generation == self._generation and self._want is not None and \
+                        i in self._window(self._want):
+                    self._decoded[i] = out
+                else:
+                    self._free.append(out)
+
+    def _next_prefetch(self):
+        if self._want is None or self.count == 0 or len(self._free) == 0:
+            return None
+        for i in self._window(self._want):
+            if i not in self._decoded:
+                return i
+        return None
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def full(self):
+        return self.count >= self.capacity or self._limited
+
+    @property
+    def nbytes(self):
+        if self.fixed_size:
+            return 0 if self.storage is None else self.storage.nbytes
+        return self._item_bytes
+
+    def close(self):
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def __repr__(self):
+        return "CompressedFrameBuffer<%s %d / %d, %d bytes>" % (self.codec.name, self.count, self.capacity, self.nbytes)
+
+
+class DedupFrameBuffer:
+    # ring of references to unique frames; a frame close enough to the newest stored one becomes another
+    # reference to it, so static stretches cost no memory and max_bytes only counts unique frames
+    signature_size = (24, 32) # blocks along the first two frame axes
+    threshold = 3. # largest difference of a block's mean, in 8-bit levels, still counted as a duplicate
+
+    def __init__(self, capacity: int, max_bytes: int = None, threshold: float = None):
+        self.requested_capacity = capacity
+        self.capacity = capacity
+        self.max_bytes = max_bytes
+        if threshold is not None:
+            self.threshold = threshold
+        self.shape = None
+        self.frame_bytes = 0
+        self.store_capacity = capacity
+
+        self.frames = [] # unique frames, allocated as needed up to store_capacity
+        self.refs = []
+        self._free = []
+        self.entries = [None] * capacity # index into frames for each ring slot
+        self.count = 0
+        self.index = 0
+        self._last = None # (frames index, signature) of the newest unique frame
+        self._limited = False
+        self.duplicates = 0
+
+    def allocate(self, shape, dtype = np.uint8):
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.frame_bytes = int(np.prod(shape)) * self.dtype.itemsize
+        self.store_capacity = self.capacity
+        if self.max_bytes is not None:
+            self.store_capacity = max(1, min(self.capacity, self.max_bytes // self.frame_bytes))
+        self.frames = []
+        self.clear()
+
+    def clear(self):
+        self.entries = [None] * self.capacity
+        self.count = 0
+        self.index = 0
+        self.refs = [0] * len(self.frames)
+        self._free = list(range(len(self.frames)))
+        self._last = None
+        self._limited = False
+
+    def signature(self, frame: np.ndarray) -> np.ndarray:
+        # the mean of each block, so motion in a small part of the frame still changes some block
+        blocks0 = min(self.signature_size[0], frame.shape[0])
+        blocks1 = min(self.signature_size[1], frame.shape[1])
+        step0, step1 = frame.shape[0] // blocks0, frame.shape[1] // blocks1
+        blocks = frame[:blocks0 * step0, :blocks1 * step1].reshape((blocks0, step0, blocks1, step1, -1))
+        return blocks.mean(axis = (1, 3), dtype = np.float32)
+
+    def _release(self, k: int):
+        self.refs[k] -= 1
+        if self.refs[k] == 0:
+            self._free.append(k)
+            if self._last is not None and self._last[0] == k:
+                self._last = None
+
+    def _drop_oldest(self):
+        self._release(self.entries[self.slot_of(0)])
+        self.count -= 1
+
+    def _store(self, frame: np.ndarray) -> int:
+        # a memory-capped store makes room by dropping the oldest frames, like the compressed buffer
+        while len(self._free) == 0 and len(self.frames) >= self.store_capacity:
+            self._drop_oldest()
+            self._limited = True
+        if self._free:
+            k = self._free.pop()
+        else:
+            k = len(self.frames)
+            self.frames.append(np.empty(self.shape, dtype = self.dtype))
+            self.refs.append(0)
+        np.copyto(self.frames[k], frame)
+        return k
+
+    def append(self, frame: np.ndarray):
+        if self.shape != frame.shape:
+            self.allocate(frame.shape, frame.dtype)
+
+        signature = self.signature(frame)
+        if self._last is not None and np.abs(signature - self._last[1]).max() <= self.threshold:
+            k = self._last[0]
+            self.refs[k] += 1 # before dropping the oldest, which may refer to the same frame
+            if self.count == self.capacity:
+                self._drop_oldest()
+            self.duplicates += 1
+        else:
+            if self.count == self.capacity:
+                self._drop_oldest()
+            k = self._store(frame)
+            self.refs[k] += 1
+            self._last = (k, signature)
+
+        self.entries[self.index] = k
+        self.index = (self.index + 1) % self.capacity
+        self.count += 1
+
+    def slot_of(self, i: int) -> int:
+        if not 0 <= i < self.count:
+            raise IndexError("frame index out of range")
+        return (self.index - self.count + i) % self.capacity
+
+    def __getitem__(self, i: int) -> np.ndarray:
+        return self.frames[self.entries[self.slot_of(i)]]
+
+    def set_playlist(self, playlist):
+        pass
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def unique_count(self):
+        return len(self.frames) - len(self._free)
+
+    @property
+    def full(self):
+        return self.count >= self.capacity or self._limited
+
+    @property
+    def nbytes(self):
+        # unique frames held; released frames stay allocated for reuse, see allocated_bytes
+        return self.unique_count * self.frame_bytes
+
+    @property
+    def allocated_bytes(self):
+        return len(self.frames) * self.frame_bytes
+
+    def close(self):
+        pass
+
+    def __repr__(self):
+        return "DedupFrameBuffer<%d / %d, %d unique, %d bytes>" % (self.count, self.capacity, self.unique_count, self.nbytes)
+
+
+def make_frame_buffer(capacity: int, compression: str = None, max_bytes: int = None, row_major: bool = False,
+        dedup: bool = False):
+    if compression is None:
+        return DedupFrameBuffer(capacity, max_bytes) if dedup else FrameRingBuffer(capacity, max_bytes)
+    if compression == 'yuv420':
+        return CompressedFrameBuffer(capacity, Yuv420Codec(), max_bytes)
+    if compression == 'jpeg':
+        return CompressedFrameBuffer(capacity, JpegCodec(row_major), max_bytes)
+    raise ValueError("Unknown loop buffer compression %r" % compression)
@@ -0,0 +1,107 @@
+import numpy as np
+
+class LoopPointFinder:
+    # keeps a small signature of every gathered frame and the squared distance between each pair,
+    # so the smoothest loop can be picked when looping starts without touching the frames again
+    # each new frame costs one signature and one row of the matrix, O(capacity)
+    signature_size = (12, 16) # samples along the first two frame axes
+    min_fraction = 0.5 # shortest loop, as a share of the gathered frames
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.signatures = None
+        self.distances = np.zeros((capacity, capacity), dtype = np.float32)
+        self._scratch = None
+        self.count = 0
+        self.index = 0 # next slot to be written
+
+    def signature(self, frame: np.ndarray) -> np.ndarray:
+        # strided subsample, works for any frame layout as long as every frame has the same one
+        step0 = max(1, frame.shape[0] // self.signature_size[0])
+        step1 = max(1, frame.shape[1] // self.signature_size[1])
+        return frame[::step0, ::step1].ravel()
+
+    def add(self, frame: np.ndarray):
+        sample = self.signature(frame)
+        if self.signatures is None or self.signatures.shape[1] != sample.size:
+            self.signatures = np.zeros((self.capacity, sample.size), dtype = np.float32)
+            self._scratch = np.empty_like(self.signatures)
+            self.clear()
+
+        slot = self.index
+        self.signatures[slot] = sample
+        np.subtract(self.signatures, self.signatures[slot], out = self._scratch)
+        np.square(self._scratch, out = self._scratch)
+        row = self._scratch.sum(axis = 1)
+        self.distances[slot, :] = row
+        self.distances[:, slot] = row
+
+        self.index = (self.index + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+
+    def clear(self):
+        self.count = 0
+        self.index = 0
+
+    def select(self, n_frames: int):
+        # returns (start, end) over the newest n_frames, oldest first, for playing frames start..end-1:
+        # frame end is the one that really followed end-1, so the pair whose frame end looks most
+        # like frame start makes the wrap look like a normal step
+        n = min(n_frames, self.count)
+        if n < 3:
+            return 0, n_frames
+        slots = (self.index - n + np.arange(n)) % self.capacity
+        cost = self.distances[np.ix_(slots, slots)] # cost[end, start]
+
+        min_length = max(2, int(self.min_fraction * n))
+        ends, starts = np.indices((n, n))
+        cost = np.where(ends - starts >= min_length, cost, np.inf)
+        end, start = np.unravel_index(np.argmin(cost), cost.shape)
+        offset = n_frames - n # frames gathered before the finder was cleared have no signature
+        return offset + int(start), offset + int(end)
+
+    def __repr__(self):
+        return "LoopPointFinder<%d / %d>" % (self.count, self.capacity)
+
+
+def crossfade(tail: np.ndarray, head: np.ndarray, out: np.ndarray) -> np.ndarray:
+    # out[k] moves from mostly tail[k] to mostly head[k], computed for the whole window at once
+    fade = len(out)
+    weights = (np.arange(1, fade + 1, dtype = np.float32) / (fade + 1)).reshape((fade, ) + (1, ) * (out.ndim - 1))
+    blend = head.astype(np.float32)
+    blend -= tail
+    blend *= weights
+    blend += tail
+    blend += 0.5 # round
+    np.copyto(out, blend, casting = 'unsafe')
+    return out
+
+class LoopSequence:
+    # the frames of one loop in playing order; the first entries may be blended frames computed
+    # once when looping starts, the rest are looked up in the frame source by index
+    def __init__(self, frames, order, blends: np.ndarray = None, blend_pairs = None):
+        self.frames = frames
+        self.order = list(order) # indices into frames, for the entries after the blends
+        self.blends = blends
+        self.n_blends = 0 if blends is None else len(blends)
+        self.blend_pairs = blend_pairs # (tail, head) frame indices each blend was made from
+
+        # a frame source that decodes ahead is read by position in the order, where a frame can
+        # appear twice with different frames after it
+        self._play = None
+        if hasattr(frames, 'set_playlist'):
+            frames.set_playlist(self.order)
+            self._play = getattr(frames, 'play', None)
+
+    def __getitem__(self, k: int) -> np.ndarray:
+        if k < self.n_blends:
+            return self.blends[k]
+        if self._play is not None:
+            return self._play(k - self.n_blends)
+        return self.frames[self.order[k - self.n_blends]]
+
+    def __len__(self):
+        return self.n_blends + len(self.order)
+
+    def __repr__(self):
+        return "LoopSequence<%d blended + %d frames>" % (self.n_blends, len(self.order))
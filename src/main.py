@@ -1,11 +1,16 @@
-from PyQt5 import uic, QtWidgets
+from PyQt5 import QtWidgets
 
 import sys
+import os
 import contextlib
 import logging
 
-from video_ui import VideoUi
+from video_ui import VideoUi, VideoHelper
 from meeting_ui import MeetingUi
+from metrics import metrics, MetricsExporter
+import ui_loader
+import quality
+import camera
 
 logging.basicConfig()
 logging.getLogger().setLevel(logging.WARN)
@@ -13,7 +18,7 @@ logging.getLogger().setLevel(logging.WARN)
 class Ui(QtWidgets.QMainWindow):
     def __init__(self):
         super(Ui, self).__init__()
-        uic.loadUi('./layout/mainWindow.ui', self)
+        ui_loader.setup_ui('./layout/mainWindow.ui', self)
 
         self.video_tab : QtWidgets.QWidget = self.findChild(QtWidgets.QWidget, 'videoTab')
         self.meeting_tab : QtWidgets.QWidget = self.findChild(QtWidgets.QWidget, 'meetingTab')
@@ -25,13 +30,33 @@ class Ui(QtWidgets.QMainWindow):
         self._ctx_stack: contextlib.ExitStack = contextlib.ExitStack()
         self._ctx_stack.enter_context(self.video_ui)
         self._ctx_stack.enter_context(self.meeting_ui)
+
+        # MMHZOOM_METRICS=path.json (or any other suffix for plain text) writes pipeline metrics periodically
+        metrics_path = os.environ.get('MMHZOOM_METRICS')
+        if metrics_path:
+            interval = float(os.environ.get('MMHZOOM_METRICS_INTERVAL', 5))
+            self._ctx_stack.enter_context(MetricsExporter(metrics, metrics_path, interval))
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         self._ctx_stack.close()
 
 
-app = QtWidgets.QApplication(sys.argv)
-with Ui() as window:
-    window.show()
-    app.exec()
+if __name__ == "__main__":
+    # MMHZOOM_QUALITY=320x240@10,640x480@15,1280x720@15 lets the video pipeline step between these levels
+    if os.environ.get('MMHZOOM_QUALITY'):
+        VideoHelper.quality_levels = quality.parse_levels(os.environ['MMHZOOM_QUALITY'])
+    # MMHZOOM_SUSPEND_CAPTURE=1 turns the camera off while looping, Speak turns it back on
+    VideoHelper.suspend_capture = os.environ.get('MMHZOOM_SUSPEND_CAPTURE', '') not in ('', '0')
+    # MMHZOOM_OUTPUT_BACKEND=pyfakewebcam writes through pyfakewebcam instead of the direct v4l2 writer
+    if os.environ.get('MMHZOOM_OUTPUT_BACKEND'):
+        if os.environ['MMHZOOM_OUTPUT_BACKEND'] not in camera.OutputCamera.BACKENDS:
+            sys.exit("MMHZOOM_OUTPUT_BACKEND must be one of %s" % ", ".join(camera.OutputCamera.BACKENDS))
+        VideoHelper.output_backend = os.environ['MMHZOOM_OUTPUT_BACKEND']
+    # MMHZOOM_AUDIO_LOOP=hw:Loopback,0 records room audio with the loop and plays it to that device
+    VideoHelper.audio_loop_device = os.environ.get('MMHZOOM_AUDIO_LOOP') or None
+
+    app = QtWidgets.QApplication(sys.argv)
+    with Ui() as window:
+        window.show()
+        app.exec()
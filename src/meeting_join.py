@@ -1,6 +1,8 @@
 from meeting import Meeting
 from typing import List
 import datetime
+import heapq
+import itertools as it
 import logging
 import webbrowser
 
@@ -15,12 +17,15 @@ def join_meeting(meeting: Meeting):
 
 
 class MeetingAutoJoin:
+    # scans every meeting on each call; MeetingScheduler replaces it, benchmark.py compares the two
     def __init__(self):
         self.last_checked = None
 
     def process(self, meetings: List[Meeting]):
         now = datetime.datetime.now()
-        assert (self.last_checked is None) or (self.last_checked < now)
+        if self.last_checked is not None and now < self.last_checked:
+            logging.info("Clock went back by %s" % (self.last_checked - now))
+            self.last_checked = now
 
         for meeting in meetings:
             if self.last_checked is None:
@@ -34,3 +39,86 @@ class MeetingAutoJoin:
             join_meeting(meeting)
 
         self.last_checked = now
+
+
+class MeetingScheduler:
+    # meetings still to be joined, in a heap keyed by meeting time; the owner runs one single-shot timer
+    # for next_delay() seconds and calls process() when it fires, so nothing runs while nothing is due.
+    # Timers count monotonic time, which stops during suspend and ignores clock changes, so the delay
+    # is capped at max_delay to notice a jumped wall clock in time.
+    max_delay = 60. # seconds
+    grace = datetime.timedelta(minutes = 15) # meetings missed by more than this, e.g. while suspended, are skipped
+
+    def __init__(self, meetings: List[Meeting] = (), clock = datetime.datetime.now, join = join_meeting):
+        self.clock = clock
+        self.join = join
+        self._counter = it.count() # breaks ties between meetings at the same time
+        self._entries = {} # id(meeting) -> heap entry
+        self._heap = []
+        self.reset(meetings)
+
+    def reset(self, meetings: List[Meeting]):
+        # meetings in the past are not joined, like the ones before the first MeetingAutoJoin.process()
+        now = self.clock()
+        self._entries = {}
+        self._heap = []
+        for meeting in meetings:
+            if meeting.datetime > now:
+                self._heap.append(self._make_entry(meeting))
+        heapq.heapify(self._heap)
+
+    def _make_entry(self, meeting: Meeting):
+        entry = [meeting.datetime, next(self._counter), meeting]
+        self._entries[id(meeting)] = entry
+        return entry
+
+    def add(self, meeting: Meeting):
+        self.remove(meeting) # scheduled once, at its current time
+        if meeting.datetime > self.clock():
+            heapq.heappush(self._heap, self._make_entry(meeting))
+
+    def remove(self, meeting: Meeting):
+        # the entry stays in the heap, marked removed, until it reaches the top
+        entry = self._entries.pop(id(meeting), None)
+        if entry is not None:
+            entry[2] = None
+
+    def replace(self, old: Meeting, new: Meeting):
+        self.remove(old)
+        self.add(new)
+
+    def _drop_removed(self):
+        while self._heap and self._heap[0][2] is None:
+            heapq.heappop(self._heap)
+
+    def next_delay(self):
+        # seconds until the next meeting is due, None when there is none
+        self._drop_removed()
+        if not self._heap:
+            return None
+        delay = (self._heap[0][0] - self.clock()).total_seconds()
+        return min(max(delay, 0.), self.max_delay)
+
+    def process(self) -> List[Meeting]:
+        # joins every meeting that is due; the wall clock may have moved either way since the last call
+        now = self.clock()
+        joined = []
+        while True:
+            self._drop_removed()
+            if not self._heap or self._heap[0][0] > now:
+                break
+            meeting_time, _, meeting = heapq.heappop(self._heap)
+            self._entries.pop(id(meeting), None)
+            if now - meeting_time > self.grace:
+                logging.info("Missed %s by %s" % (meeting, now - meeting_time))
+                continue
+            logging.info("Auto-join %s" % meeting)
+            self.join(meeting)
+            joined.append(meeting)
+        return joined
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __repr__(self):
+        return "MeetingScheduler<#%d>" % len(self)
@@ -1,4 +1,3 @@
-from PyQt5 import uic
 from PyQt5.QtCore import QTimer, QModelIndex, QDate, QDateTime
 from PyQt5 import QtWidgets
 
@@ -6,12 +5,13 @@ import logging
 import datetime
 
 from meeting import Meeting, MeetingList
-from meeting_join import MeetingAutoJoin
+from meeting_join import MeetingScheduler
+import ui_loader
 
 class MeetingEditDialog(QtWidgets.QDialog):
     def __init__(self, meeting: Meeting = None):
         super(MeetingEditDialog, self).__init__()
-        uic.loadUi('./layout/meetingEditDialog.ui', self)
+        ui_loader.setup_ui('./layout/meetingEditDialog.ui', self)
 
         self.meeting_id_input : QtWidgets.QLineEdit = self.findChild(QtWidgets.QLineEdit, 'meetingIdInput')
         self.password_input : QtWidgets.QLineEdit = self.findChild(QtWidgets.QLineEdit, 'passwordInput')
@@ -65,15 +65,24 @@ class MeetingUi:
         self.model = MeetingList.load_from_file()
         self.update_meeting_list()
 
-        self.auto_join = MeetingAutoJoin()
+        self.scheduler = MeetingScheduler(self.model.get_meetings())
 
+        # fires once per due meeting, and not at all while no meeting is scheduled
         self.timer = QTimer()
-        self.timer.setInterval(1000)
+        self.timer.setSingleShot(True)
         self.timer.timeout.connect(self.auto_join_meeting)
-        self.timer.start()
+        self.reschedule()
 
     def auto_join_meeting(self):
-        self.auto_join.process(self.model.get_meetings())
+        self.scheduler.process()
+        self.reschedule()
+
+    def reschedule(self):
+        delay = self.scheduler.next_delay()
+        if delay is None:
+            self.timer.stop()
+        else:
+            self.timer.start(int(delay * 1000))
 
     def update_meeting_list(self):
         self.meeting_list.clear()
@@ -89,8 +98,11 @@ class MeetingUi:
         dialog = MeetingEditDialog()
         if dialog.exec_():
             try:
-                self.model.add_meeting(Meeting(*dialog.get_fields()))
+                meeting = Meeting(*dialog.get_fields())
+                self.model.add_meeting(meeting)
                 self.model.save()
+                self.scheduler.add(meeting)
+                self.reschedule()
                 self.update_meeting_list()
             except ValueError as e:
                 pass
@@ -101,8 +113,10 @@ class MeetingUi:
         if index < 0:
             return
 
+        self.scheduler.remove(self.model.get_index(index))
         self.model.remove_index(index)
         self.model.save()
+        self.reschedule()
         self.update_meeting_list()
 
     def select_meeting_item(self):
@@ -118,6 +132,8 @@ class MeetingUi:
                 new_meeting = Meeting(*dialog.get_fields())
                 self.model.replace_index(index, new_meeting)
                 self.model.save()
+                self.scheduler.replace(meeting, new_meeting)
+                self.reschedule()
                 self.update_meeting_list()
             except ValueError: pass
 
@@ -0,0 +1,165 @@
+import bisect
+import collections
+import contextlib
+import json
+import logging
+import pathlib
+import threading
+import time
+
+class RollingHistogram:
+    # durations of the last `window` samples, in seconds
+    bucket_edges = [0.001, 0.002, 0.004, 0.008, 0.016, 0.033, 0.066, 0.133, 0.266] # upper bounds
+
+    def __init__(self, window: int = 120):
+        self.samples = collections.deque(maxlen = window)
+        self.total_count = 0
+
+    def add(self, seconds: float):
+        self.samples.append(seconds)
+        self.total_count += 1
+
+    def percentile(self, p: float) -> float:
+        if len(self.samples) == 0:
+            return 0.
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(p / 100 * len(ordered)))]
+
+    @property
+    def mean(self) -> float:
+        return sum(self.samples) / len(self.samples) if self.samples else 0.
+
+    def buckets(self):
+        counts = [0] * (len(self.bucket_edges) + 1)
+        for x in self.samples:
+            counts[bisect.bisect_left(self.bucket_edges, x)] += 1
+        return counts
+
+    def snapshot(self):
+        ms = 1000
+        return {
+            'count': self.total_count,
+            'mean_ms': self.mean * ms,
+            'p50_ms': self.percentile(50) * ms,
+            'p95_ms': self.percentile(95) * ms,
+            'max_ms': max(self.samples, default = 0.) * ms,
+            'bucket_edges_ms': [x * ms for x in self.bucket_edges],
+            'buckets': self.buckets(),
+        }
+
+
+class PipelineMetrics:
+    # per-stage timings, counters and gauges shared by the capture, output and preview threads
+    def __init__(self):
+        self._mutex = threading.Lock()
+        self.stages = collections.OrderedDict()
+        self.counters = collections.OrderedDict()
+        self.gauges = collections.OrderedDict()
+
+    def record(self, stage: str, seconds: float):
+        with self._mutex:
+            histogram = self.stages.get(stage)
+            if histogram is None:
+                histogram = self.stages[stage] = RollingHistogram()
+            histogram.add(seconds)
+
+    @contextlib.contextmanager
+    def time(self, stage: str):
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - start_time)
+
+    def count(self, name: str, n: int = 1):
+        with self._mutex:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def set_gauge(self, name: str, value: float):
+        with self._mutex:
+            self.gauges[name] = value
+
+    def reset(self):
+        with self._mutex:
+            self.stages.clear()
+            self.counters.clear()
+            self.gauges.clear()
+
+    def snapshot(self):
+        with self._mutex:
+            return {
+                'time': time.time(),
+                'stages': {name: h.snapshot() for name, h in self.stages.items()},
+                'counters': dict(self.counters),
+                'gauges': dict(self.gauges),
+            }
+
+    def summary(self) -> str:
+        # one line for the status bar
+        with self._mutex:
+            parts = []
+            if 'fps' in self.gauges:
+                parts.append("%.1f fps" % self.gauges['fps'])
+            parts += ["%s %.1f ms" % (name, h.mean * 1000) for name, h in self.stages.items() if name != 'sleep']
+            parts += ["%s %d" % (name, n) for name, n in self.counters.items() if n]
+            return " | ".join(parts)
+
+    def format_text(self) -> str:
+        snapshot = self.snapshot()
+        lines = [time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(snapshot['time']))]
+        for name, s in snapshot['stages'].items():
+            lines.append("%-10s n=%-8d mean %6.2f ms  p50 %6.2f ms  p95 %6.2f ms  max %6.2f ms" % (
+                name, s['count'], s['mean_ms'], s['p50_ms'], s['p95_ms'], s['max_ms']))
+        for name, value in snapshot['gauges'].items():
+            lines.append("%-10s %.2f" % (name, value))
+        for name, value in snapshot['counters'].items():
+            lines.append("%-10s %d" % (name, value))
+        return "\n".join(lines) + "\n"
+
+    def export(self, path: pathlib.Path):
+        # JSON for a .json path, plain text otherwise
+        path = pathlib.Path(path)
+        if path.suffix == '.json':
+            data = json.dumps(self.snapshot(), indent = 1)
+        else:
+            data = self.format_text()
+        tmp_path = path.with_name(path.name + '.tmp')
+        with open(tmp_path, "w") as f:
+            f.write(data)
+        tmp_path.replace(path)
+
+
+class MetricsExporter:
+    # writes the metrics to a file every `interval` seconds on a background thread
+    def __init__(self, metrics: PipelineMetrics, path: pathlib.Path, interval: float = 5.):
+        self.metrics = metrics
+        self.path = pathlib.Path(path)
+        self.interval = interval
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target = self._run, daemon = True)
+        self._thread.start()
+        return self
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.metrics.export(self.path)
+            except OSError as e:
+                logging.error("Cannot write metrics to %s: %s" % (self.path, e))
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+metrics = PipelineMetrics()
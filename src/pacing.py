@@ -0,0 +1,78 @@
+import collections
+import math
+import time
+
+class FramePacer:
+    # paces frames against absolute deadlines on the monotonic clock, so time spent writing,
+    # emitting signals and oversleeping is absorbed by the next wait instead of accumulating
+    stats_window = 60 # frames
+    max_lag = 1 # frames we may run behind before skipping ahead
+
+    def __init__(self, fps: float, clock = time.monotonic, sleep = time.sleep):
+        self.clock = clock
+        self.sleep = sleep
+        self.set_fps(fps)
+
+        self.deadline = None
+        self.last_tick = None
+        self.skipped = 0
+        self._intervals = collections.deque(maxlen = self.stats_window)
+
+    def set_fps(self, fps: float):
+        # fps = 0 runs unpaced, e.g. to measure throughput
+        self.fps = fps
+        self.period = 1 / fps if fps else 0.
+
+    def reset(self):
+        self.deadline = None
+        self.last_tick = None
+        self._intervals.clear()
+
+    def wait(self) -> int:
+        # sleeps until the next frame is due, returns the number of frames to skip to catch up
+        if not self.fps:
+            self._tick()
+            return 0
+
+        now = self.clock()
+        if self.deadline is None:
+            self.deadline = now
+
+        self.deadline += self.period
+        missed = 0
+        if now < self.deadline:
+            self.sleep(self.deadline - now)
+        else:
+            lag = math.floor((now - self.deadline) / self.period)
+            if lag >= self.max_lag:
+                missed = lag
+                self.deadline += missed * self.period
+                self.skipped += missed
+
+        self._tick()
+        return missed
+
+    def _tick(self):
+        now = self.clock()
+        if self.last_tick is not None:
+            self._intervals.append(now - self.last_tick)
+        self.last_tick = now
+
+    @property
+    def achieved_fps(self):
+        if len(self._intervals) == 0:
+            return 0.
+        return len(self._intervals) / sum(self._intervals)
+
+    @property
+    def jitter(self):
+        # standard deviation of frame intervals, in seconds
+        n = len(self._intervals)
+        if n < 2:
+            return 0.
+        mean = sum(self._intervals) / n
+        return math.sqrt(sum((x - mean) ** 2 for x in self._intervals) / (n - 1))
+
+    def __repr__(self):
+        return "FramePacer<%.1f / %.1f fps, jitter %.1f ms, %d skipped>" % (
+            self.achieved_fps, self.fps, self.jitter * 1000, self.skipped)
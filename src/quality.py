@@ -0,0 +1,121 @@
+import collections
+import threading
+import time
+
+import numpy as np
+
+from metrics import metrics
+
+QualityLevel = collections.namedtuple('QualityLevel', ['size', 'fps'])
+
+def parse_levels(text: str):
+    # "320x240@10,640x480@15,1280x720@15"
+    levels = []
+    for item in text.split(','):
+        size, fps = item.strip().split('@')
+        width, height = size.lower().split('x')
+        levels.append(QualityLevel((int(width), int(height)), float(fps)))
+    return levels
+
+class Rescaler:
+    # nearest-neighbour resize over the first two axes into preallocated buffers,
+    # so frames captured at a lower resolution reach the output at its fixed size
+    def __init__(self, src_shape, dst_shape, dtype = np.uint8):
+        self.src_shape, self.dst_shape = tuple(src_shape), tuple(dst_shape)
+        self.rows = (np.arange(dst_shape[0]) * src_shape[0] // dst_shape[0]).astype(np.intp)
+        self.cols = (np.arange(dst_shape[1]) * src_shape[1] // dst_shape[1]).astype(np.intp)
+        self._rows_out = np.empty((dst_shape[0], src_shape[1]) + tuple(src_shape[2:]), dtype = dtype)
+        self.out = np.empty(dst_shape, dtype = dtype)
+
+    def resize(self, frame: np.ndarray, out: np.ndarray = None) -> np.ndarray:
+        # without out, the result is overwritten by the next call
+        if out is None:
+            out = self.out
+        np.take(frame, self.rows, axis = 0, out = self._rows_out, mode = 'clip')
+        np.take(self._rows_out, self.cols, axis = 1, out = out, mode = 'clip')
+        return out
+
+    def __repr__(self):
+        return "Rescaler(%r, %r)" % (self.src_shape, self.dst_shape)
+
+
+class QualityController:
+    # steps through quality levels, lowest first, by how much of the frame time the slowest stage takes
+    # stages are timed on different threads and run in parallel, so each has the whole frame time to itself
+    window = 30 # samples per stage before deciding
+    high_load = 0.8 # step down when the slowest stage takes more than this share of the frame time
+    low_load = 0.4 # step up when it takes less than this
+    cooldown = 3. # seconds between changes, so a changed level is measured before the next decision
+
+    def __init__(self, levels, start: int = None, clock = time.monotonic):
+        if len(levels) == 0:
+            raise ValueError("QualityController needs at least one level")
+        self.levels = sorted(levels, key = lambda l: (l.size[0] * l.size[1], l.fps))
+        self.index = len(self.levels) - 1 if start is None else start
+        self.clock = clock
+
+        self._mutex = threading.Lock()
+        self._samples = {}
+        self._last_change = clock()
+
+    @property
+    def level(self) -> QualityLevel:
+        return self.levels[self.index]
+
+    @property
+    def max_size(self):
+        # the output keeps this size whatever the level
+        return max((l.size for l in self.levels), key = lambda size: size[0] * size[1])
+
+    def observe(self, stage: str, seconds: float):
+        with self._mutex:
+            samples = self._samples.get(stage)
+            if samples is None:
+                samples = self._samples[stage] = collections.deque(maxlen = self.window)
+            samples.append(seconds)
+
+    def load(self) -> float:
+        # 90th percentile time of the slowest stage, as a share of the frame time
+        with self._mutex:
+            return self._load()
+
+    def _load(self):
+        worst = 0.
+        for samples in self._samples.values():
+            if len(samples):
+                ordered = sorted(samples)
+                worst = max(worst, ordered[int(0.9 * (len(ordered) - 1))])
+        return worst * self.level.fps
+
+    def update(self) -> QualityLevel:
+        # returns the new level when it should change, None otherwise
+        with self._mutex:
+            now = self.clock()
+            if now - self._last_change < self.cooldown:
+                return None
+            if len(self._samples) == 0 or any(len(s) < self.window for s in self._samples.values()):
+                return None
+
+            load = self._load()
+            metrics.set_gauge('load', load)
+            if load > self.high_load and self.index > 0:
+                self.index -= 1
+            elif load < self.low_load and self.index < len(self.levels) - 1:
+                self.index += 1
+            else:
+                return None
+
+            self._samples.clear()
+            self._last_change = now
+            metrics.count('quality_changes')
+            return self.level
+
+    def set_index(self, index: int):
+        with self._mutex:
+            self.index = index
+            self._samples.clear()
+            self._last_change = self.clock()
+
+    def __repr__(self):
+        return "QualityController<%dx%d @ %g fps, level %d / %d>" % (
+            self.level.size + (self.level.fps, self.index, len(self.levels)))
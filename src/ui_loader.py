@@ -0,0 +1,64 @@
+import hashlib
+import importlib.util
+import io
+import logging
+import pathlib
+import threading
+import types
+
+import xdg
+from PyQt5.QtCore import PYQT_VERSION_STR
+
+# .ui layouts compiled to Python once and kept under XDG_CACHE_HOME, so neither startup nor opening a
+# dialog parses XML; a changed layout gets a new cache entry, keyed by its contents
+
+_mutex = threading.Lock()
+_form_classes = {}
+
+def get_cache_path() -> pathlib.Path:
+    return xdg.XDG_CACHE_HOME / 'mmhZoom' / 'ui'
+
+def _compile(ui_path: pathlib.Path) -> str:
+    from PyQt5 import uic # the compiler is only needed on a cache miss
+    source = io.StringIO()
+    uic.compileUi(str(ui_path), source)
+    return source.getvalue()
+
+def _load_module(name: str, ui_path: pathlib.Path, data: bytes):
+    # the generated code also depends on the PyQt5 version
+    key = hashlib.sha1(data + PYQT_VERSION_STR.encode()).hexdigest()[:16]
+    cache_path = get_cache_path() / ('%s_%s.py' % (name, key))
+    if not cache_path.exists():
+        source = _compile(ui_path)
+        try:
+            cache_path.parent.mkdir(parents = True, exist_ok = True)
+            tmp_path = cache_path.with_name(cache_path.name + '.tmp')
+            tmp_path.write_text(source)
+            tmp_path.replace(cache_path)
+        except OSError as e:
+            logging.info("Cannot cache compiled layout %s: %s" % (cache_path, e))
+            module = types.ModuleType(name)
+            exec(compile(source, str(ui_path), 'exec'), module.__dict__)
+            return module
+
+    spec = importlib.util.spec_from_file_location(cache_path.stem, cache_path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def load_form_class(ui_path):
+    # returns the Ui_* class generated for the layout; form_class().setupUi(widget) builds it into widget
+    ui_path = pathlib.Path(ui_path)
+    with _mutex:
+        form_class = _form_classes.get(ui_path)
+        if form_class is None:
+            module = _load_module(ui_path.stem, ui_path, ui_path.read_bytes())
+            form_class = next(getattr(module, k) for k in dir(module) if k.startswith('Ui_'))
+            _form_classes[ui_path] = form_class
+        return form_class
+
+def setup_ui(ui_path, widget):
+    # drop-in for uic.loadUi(ui_path, widget)
+    form = load_form_class(ui_path)()
+    form.setupUi(widget)
+    return form
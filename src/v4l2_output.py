@@ -0,0 +1,67 @@
+import fcntl
+import logging
+import os
+
+import pyfakewebcam.v4l2 as v4l2
+
+class V4l2Writer:
+    # writes packed frames to a v4l2loopback output device, with the format negotiated through ioctls
+    def __init__(self, device_id: str, width: int, height: int, pixelformat: int = v4l2.V4L2_PIX_FMT_YUYV):
+        if not os.path.exists(device_id):
+            raise FileNotFoundError("Output device does not exist: %s" % device_id)
+
+        self.device_id = device_id
+        self.fd = os.open(device_id, os.O_WRONLY)
+        try:
+            self._check_capabilities()
+            self.format = self._negotiate(width, height, pixelformat)
+        except Exception:
+            os.close(self.fd)
+            raise
+
+        pix = self.format.fmt.pix
+        self.width, self.height = pix.width, pix.height
+        self.frame_size = pix.sizeimage
+        logging.info("Negotiated %dx%d, %d bytes per frame on %s" % (self.width, self.height, self.frame_size, device_id))
+
+    def _check_capabilities(self):
+        capability = v4l2.v4l2_capability()
+        fcntl.ioctl(self.fd, v4l2.VIDIOC_QUERYCAP, capability)
+        if not capability.capabilities & v4l2.V4L2_CAP_VIDEO_OUTPUT:
+            raise ValueError("%s is not a video output device (driver %r)" % (self.device_id, capability.driver.decode()))
+
+    def _negotiate(self, width, height, pixelformat):
+        fmt = v4l2.v4l2_format()
+        fmt.type = v4l2.V4L2_BUF_TYPE_VIDEO_OUTPUT
+        fmt.fmt.pix.width = width
+        fmt.fmt.pix.height = height
+        fmt.fmt.pix.pixelformat = pixelformat
+        fmt.fmt.pix.field = v4l2.V4L2_FIELD_NONE
+        fmt.fmt.pix.bytesperline = width * 2
+        fmt.fmt.pix.sizeimage = width * height * 2
+        fmt.fmt.pix.colorspace = v4l2.V4L2_COLORSPACE_JPEG
+        fcntl.ioctl(self.fd, v4l2.VIDIOC_S_FMT, fmt)
+
+        # the driver may adjust the request, read back what it settled on
+        fmt_read = v4l2.v4l2_format()
+        fmt_read.type = v4l2.V4L2_BUF_TYPE_VIDEO_OUTPUT
+        fcntl.ioctl(self.fd, v4l2.VIDIOC_G_FMT, fmt_read)
+        pix = fmt_read.fmt.pix
+        if (pix.width, pix.height, pix.pixelformat) != (width, height, pixelformat):
+            raise ValueError("Device %s negotiated %dx%d instead of %dx%d" % (self.device_id, pix.width, pix.height, width, height))
+        return fmt_read
+
+    def write(self, data):
+        view = memoryview(data).cast('B')
+        if len(view) != self.frame_size:
+            raise ValueError("Frame is %d bytes, device expects %d" % (len(view), self.frame_size))
+        while len(view):
+            view = view[os.write(self.fd, view):]
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def __repr__(self):
+        return "V4l2Writer(%r, %dx%d)" % (self.device_id, self.width, self.height)
@@ -1,13 +1,21 @@
-from PyQt5 import uic, QtWidgets, QtSvg, QtGui
-from PyQt5.QtCore import pyqtSignal, pyqtSlot, QObject, QTimer, QMutex, QThread
-from PyQt5.QtGui import QPixmap, QImage, QPainter, QPalette
+from PyQt5 import QtWidgets, QtGui
+from PyQt5.QtCore import pyqtSignal, pyqtSlot, QObject, QTimer, QMutex, QThread, QFileSystemWatcher, QMetaObject, Qt
+from PyQt5.QtGui import QPixmap, QImage
 
 import sys
 import contextlib
 import logging
+import threading
+import time
+
+import numpy as np
 
 import camera
 import audio
+import devices
+from metrics import metrics
+import clip_library
+import quality
 
 # https://www.learnpyqt.com/tutorials/multithreading-pyqt-applications-qthreadpool/
 # Bidirctonal callbacks:
@@ -51,8 +59,168 @@ class VideoWorker(QObject):
         with self:
             self._running = False
 
+class PreviewWorker(QObject):
+    # captures and converts preview frames on its own thread, the GUI thread only swaps the pixmap
+    signalFrame = pyqtSignal(QImage)
+
+    preview_fps = 5.0
+    max_interval = 1000 # ms
+
+    def __init__(self):
+        super(QObject, self).__init__()
+        self._mutex = QMutex()
+        self._running = True
+        self.input_cam, self.live = None, False
+        self.last_seq = None
+        self.timer = None
+
+    def __enter__(self):
+        self._mutex.lock()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._mutex.unlock()
+
+    def set_source(self, input_cam: camera.RealCamera, live: bool):
+        # waits for a capture in progress, so the caller may release the previous camera afterwards
+        with self:
+            self.input_cam, self.live = input_cam, live
+            self.last_seq = None
+
+    @pyqtSlot()
+    def start(self):
+        self.timer = QTimer()
+        self.timer.setSingleShot(True)
+        self.timer.timeout.connect(self.render)
+        self.timer.start(0)
+
+    @pyqtSlot()
+    def render(self):
+        start_time = time.monotonic()
+        with self:
+            if not self._running:
+                return
+            image = self.render_frame()
+        if image is not None:
+            self.signalFrame.emit(image)
+
+        # back off while producing a frame eats into the preview budget
+        elapsed = (time.monotonic() - start_time) * 1000
+        interval = min(self.max_interval, max(1000 / self.preview_fps, 4 * elapsed))
+        self.timer.start(int(interval))
+
+    def render_frame(self) -> QImage:
+        if self.input_cam is None:
+            #renderer =  QtSvg.QSvgRenderer('./assets/no-video.svg')
+            image = QImage(100, 100, QImage.Format_RGB888)
+            image.fill(0)
+            return image
+
+        if self.live:
+            # skip the conversion entirely when the capture thread has nothing new
+            seq, data = self.input_cam.latest.read(self.last_seq)
+        else:
+            seq, data = None, self.input_cam.read()
+
+        if data is None:
+            return None
+
+        # https://pythonbasics.org/pyqt-qpixmap/
+        # https://stackoverflow.com/questions/45018926/how-to-properly-setpixmap-scaled-on-pyqt5#45019730
+        # https://stackoverflow.com/questions/40391901/getting-webcam-footage-from-opencv-to-pyqt/42844998
+        with metrics.time('preview'):
+            data = data[::2, ::2, :] # downscale
+            if self.input_cam.layout == camera.COLUMN_MAJOR:
+                data = data.transpose((1,0,2))
+            data = np.ascontiguousarray(data)
+        if seq is not None:
+            if not self.input_cam.latest.valid(seq):
+                return None # overwritten while we were reading it, try again next tick
+            self.last_seq = seq
+
+        height, width, channels = data.shape
+        bpl = 3 * width
+        return QImage(data, width, height, bpl, QImage.Format_RGB888).copy() # detach from data
+
+    @pyqtSlot()
+    def stop(self):
+        # runs on the preview thread, which owns the timer
+        with self:
+            self._running = False
+        if self.timer:
+            self.timer.stop()
+            self.timer.deleteLater()
+            self.timer = None
+
+class DeviceWatcher(QObject):
+    # rescans the device registry off the GUI thread whenever /dev changes
+    signalDevicesChanged = pyqtSignal()
+
+    def __init__(self, registry: devices.DeviceRegistry):
+        super(QObject, self).__init__()
+        self.registry = registry
+        self.watcher = QFileSystemWatcher([str(registry.dev_path)])
+        self.watcher.directoryChanged.connect(self.refresh)
+
+    def refresh(self, path = None):
+        force = not self.registry.scanned
+        threading.Thread(target = self._refresh, args = (force, ), daemon = True).start()
+
+    def _refresh(self, force):
+        added, removed = self.registry.refresh()
+        if force or added or removed:
+            self.signalDevicesChanged.emit()
+
+class AudioWatcher(QObject):
+    # carries capture switch changes from the mixer event thread to the GUI thread
+    signalCaptureChanged = pyqtSignal(bool)
+
+class CameraOpener(QObject):
+    # opens the preview camera off the GUI thread, opening a camera and loading pygame take a while
+    signalOpened = pyqtSignal()
+
+    def __init__(self):
+        super(QObject, self).__init__()
+        self._mutex = threading.Lock()
+        self._thread = None
+        self._result = None
+
+    def open(self, device_id):
+        self.wait()
+        stale = self.take()
+        if stale and stale[1]:
+            stale[1].release()
+        self._thread = threading.Thread(target = self._open, args = (device_id, ), daemon = True)
+        self._thread.start()
+
+    def _open(self, device_id):
+        try:
+            cam = camera.open_input_camera(device_id, layout = camera.ROW_MAJOR)
+            error = None
+        except (SystemError, ValueError, OSError) as e:
+            cam, error = None, e
+        with self._mutex:
+            self._result = (device_id, cam, error)
+        self.signalOpened.emit()
+
+    def wait(self):
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def take(self):
+        # returns (device_id, camera, error) of the last open, or None once taken
+        with self._mutex:
+            result, self._result = self._result, None
+            return result
+
 class VideoHelper:
-    def __init__(self, input_device: str, output_device: str, ui: 'Ui'):
+    output_backend = camera.OutputCamera.V4L2
+    quality_levels = None # list of quality.QualityLevel, enables adaptive quality
+    suspend_capture = False # stop the camera while looping
+    audio_loop_device = None # sound device the loop's audio is played to, e.g. 'hw:Loopback,0'
+
+    def __init__(self, input_device: str, output_device, ui: 'Ui'):
+        # output_device may be a list of devices, all fed from the one input camera
         self.ui = ui
 
         if input_device is None:
@@ -61,28 +229,45 @@ class VideoHelper:
         if output_device is None:
             output_device = camera.OutputCamera.get_default_device()
 
-        if input_device == output_device:
+        output_devices = list(output_device) if isinstance(output_device, (list, tuple)) else [output_device]
+        if input_device in output_devices:
             raise ValueError
 
+        # with adaptive quality the outputs are opened at the largest level's size and keep it
+        quality_controller = quality.QualityController(self.quality_levels) if self.quality_levels else None
+        output_size = quality_controller.max_size if quality_controller else (640,480)
+
         try:
             self.worker, self.worker_thread = None, None
             self.input_cam, self.output_cam = None, None
+            self.output_cams = []
 
             if isinstance(input_device, camera.InputCamera):
                 self.input_cam = input_device
             else:
                 logging.info("Create input camera")
-                self.input_cam = camera.RealCamera(input_device).init()
-
-            if isinstance(output_device, camera.OutputCamera):
-                self.output_cam = output_device
-            else:
-                logging.info("Create output camera")
-                self.output_cam = camera.OutputCamera(output_device).init()
-
-            looper = camera.VideoLooper(self.input_cam, self.output_cam)
+                self.input_cam = camera.open_input_camera(input_device, layout = camera.ROW_MAJOR)
+            if quality_controller and tuple(self.input_cam.size or ()) != quality_controller.level.size:
+                self.input_cam.reopen(quality_controller.level.size, quality_controller.level.fps)
+
+            for device in output_devices:
+                if isinstance(device, camera.OutputCamera):
+                    self.output_cams.append(device)
+                else:
+                    logging.info("Create output camera %s" % device)
+                    self.output_cams.append(camera.OutputCamera(device, output_size, backend = self.output_backend).init())
+            self.output_cam = self.output_cams[0]
+
+            audio_loop = None
+            if self.audio_loop_device:
+                import audio_loop as audio_loop_module
+                audio_loop = audio_loop_module.AudioLoop(playback_device = self.audio_loop_device)
+            looper = camera.VideoLooper(self.input_cam, self.output_cams, quality = quality_controller,
+                suspend_capture = self.suspend_capture, audio_loop = audio_loop)
             self.worker = VideoWorker(looper)
             self.worker.signalLoopStatus.connect(self.update_loop_button)
+            if audio_loop is not None:
+                audio_loop.open() # closed by release() through the looper if this fails
 
             self.worker_thread = QThread()
             self.worker.moveToThread(self.worker_thread)
@@ -98,6 +283,12 @@ class VideoHelper:
     def set_looping(self, value: bool):
         self.worker.set_looping(value)
 
+    def set_clip(self, frames, layout: str = None):
+        self.worker.looper.set_clip(frames, layout)
+
+    def save_clip(self, library: clip_library.ClipLibrary, name: str):
+        self.worker.looper.save_clip(library, name)
+
     def can_loop(self):
         return self.worker.can_loop
 
@@ -112,19 +303,21 @@ class VideoHelper:
             logging.info("Wait on worker thread")
             self.worker_thread.wait()
 
+        if self.worker:
+            self.worker.looper.close()
+
         if self.input_cam:
             logging.info("Release input camera")
             self.input_cam.release()
 
-        if self.output_cam:
-            logging.info("Release output camera")
-            self.output_cam.release()
+        for output_cam in self.output_cams:
+            logging.info("Release output camera %s" % output_cam.device_id)
+            output_cam.release()
 
 
 class VideoUi:
     mainthread_callback_to_worker = pyqtSignal()
-    
-    preview_fps = 5.0
+    open_file_item = 'Open video file...'
 
     def __init__(self, window: QtWidgets.QMainWindow, video_tab: QtWidgets.QWidget):
         self.video_button : QtWidgets.QPushButton = video_tab.findChild(QtWidgets.QPushButton, 'videoToggle')
@@ -139,14 +332,34 @@ class VideoUi:
         self.video_source : QtWidgets.QComboBox = video_tab.findChild(QtWidgets.QComboBox, 'videoSource')
         self.video_source.activated.connect(self.select_video_source)
 
+        self.clip_source : QtWidgets.QComboBox = video_tab.findChild(QtWidgets.QComboBox, 'clipSource')
+        self.clip_source.activated.connect(self.select_clip)
+
+        self.save_clip_button : QtWidgets.QPushButton = video_tab.findChild(QtWidgets.QPushButton, 'saveClip')
+        self.save_clip_button.clicked.connect(self.save_clip)
+
         self.status_bar : QtWidgets.QStatusBar = window.findChild(QtWidgets.QStatusBar, 'statusBar')
 
+        self.window = window
         self.worker = None
 
-        self.timer = QTimer()
-        self.timer.setInterval(1000 // self.preview_fps)
-        self.timer.timeout.connect(self.render_preview_frame)
-        self.timer.start()
+        self.metrics_label = QtWidgets.QLabel()
+        self.status_bar.addPermanentWidget(self.metrics_label)
+        self.metrics_timer = QTimer()
+        self.metrics_timer.setInterval(1000)
+        self.metrics_timer.timeout.connect(self.update_metrics)
+        self.metrics_timer.start()
+
+        self.clip_library = clip_library.ClipLibrary()
+        self.clip_name = None
+        self.update_clip_list()
+
+        self.preview_worker = PreviewWorker()
+        self.preview_worker.signalFrame.connect(self.show_preview_frame)
+        self.preview_thread = QThread()
+        self.preview_worker.moveToThread(self.preview_thread)
+        self.preview_thread.started.connect(self.preview_worker.start)
+        self.preview_thread.start()
 
         #self.preview : QtWidgets.QGraphicsView = video_tab.findChild(QtWidgets.QGraphicsView, 'previewView')
         self.preview : QtWidgets.QLabel = video_tab.findChild(QtWidgets.QLabel, 'previewView')
@@ -154,28 +367,69 @@ class VideoUi:
         self.video_helper = None
 
         self.input_device_id, self.input_cam = None, None
-        self.update_device_list()
+        self.camera_opener = CameraOpener()
+        self.camera_opener.signalOpened.connect(self.camera_opened)
+        self.video_files = [] # files picked through open_file_item, listed after the cameras
+
+        # the device list fills in once the background scan finishes
+        self.device_watcher = DeviceWatcher(devices.registry)
+        self.device_watcher.signalDevicesChanged.connect(self.update_device_list)
+        self.device_watcher.refresh()
+
+        self._audio = None
+        self._audio_mutex = threading.Lock()
+        self.audio_watcher = AudioWatcher()
+        self.audio_watcher.signalCaptureChanged.connect(self.capture_changed)
+        # the mixer is found in the background once the window is up, or on first use
+        QTimer.singleShot(0, self.start_audio)
 
-        self.set_input_device(camera.RealCamera.get_default_device())
+        self.update_loop_button()
 
-        self.audio : audio.Audio = audio.Audio()
+    def start_audio(self):
+        threading.Thread(target = lambda: self.audio, daemon = True).start()
 
-        self.update_loop_button()
+    @property
+    def audio(self) -> audio.AudioController:
+        with self._audio_mutex:
+            if self._audio is None:
+                self._audio = audio.AudioController()
+                self._audio.add_listener(self.audio_watcher.signalCaptureChanged.emit)
+            return self._audio
 
     def __enter__(self):
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
+        self.camera_opener.wait()
+
+        QMetaObject.invokeMethod(self.preview_worker, 'stop', Qt.BlockingQueuedConnection)
+        self.preview_thread.quit()
+        self.preview_thread.wait()
+
         if self.video_helper:
             self.video_helper.release()
 
-    def update_device_list(self):
-        devices = camera.RealCamera.get_devices()
-        default_device = camera.RealCamera.get_default_device()
+        if self._audio is not None:
+            self._audio.close()
 
-        self.video_source.addItems(devices)
-        if self.video_source.currentIndex() < 0 and default_device in devices:
-            self.video_source.setCurrentIndex(devices.index(default_device))
+    def update_device_list(self):
+        device_ids = camera.RealCamera.get_devices() + self.video_files
+
+        self.video_source.clear()
+        self.video_source.addItems(device_ids)
+        self.video_source.addItem(self.open_file_item)
+        if self.input_device_id in device_ids:
+            self.video_source.setCurrentIndex(device_ids.index(self.input_device_id))
+        elif self.video_helper is None:
+            # selected camera was unplugged, or nothing selected yet
+            self.preview_worker.set_source(None, False)
+            if self.input_cam:
+                self.input_cam.release()
+                self.input_cam = None
+            self.input_device_id = None
+            if len(device_ids) > 0:
+                self.video_source.setCurrentIndex(0)
+                self.set_input_device(device_ids[0])
 
     # https://stackoverflow.com/questions/39235687/when-qcombobox-is-set-editable#39236399
     def select_video_source(self, index = None):
@@ -184,22 +438,53 @@ class VideoUi:
 
         if index is None:
             self.set_input_device(None)
+        elif self.video_source.itemText(index) == self.open_file_item:
+            self.open_video_file()
         else:
             self.set_input_device(self.video_source.itemText(index))
 
+    def open_video_file(self):
+        path, _ = QtWidgets.QFileDialog.getOpenFileName(self.window, 'Open video file', '',
+            'Videos (*.mp4 *.mkv *.webm *.avi *.mov);;All files (*)')
+        if path:
+            if path not in self.video_files:
+                self.video_files.append(path)
+            self.set_input_device(path)
+        self.update_device_list()
+
     def set_input_device(self, device_id):
         self.input_device_id = device_id
+        self.preview_worker.set_source(None, False)
 
         if self.input_cam:
             self.input_cam.release()
             self.input_cam = None
 
-        try:
-            self.input_cam = camera.RealCamera(self.input_device_id).init()
-        except SystemError:
-            self.input_cam = None
+        if device_id is not None:
+            self.camera_opener.open(device_id)
+        self.update_preview_source()
+
+    def camera_opened(self):
+        result = self.camera_opener.take()
+        if result is None:
+            return
+        device_id, cam, error = result
+        if device_id != self.input_device_id or self.video_helper or self.input_cam:
+            # another device was picked meanwhile, or video started with its own camera
+            if cam:
+                cam.release()
+            return
+
+        if isinstance(error, (ValueError, OSError)):
+            # unreadable video file, or ffmpeg missing
+            logging.error("Cannot open %s: %s" % (device_id, error))
+            self.status_bar.showMessage('Error: Cannot open %s' % device_id)
+        self.input_cam = cam
+        self.update_preview_source()
 
     def toggle_video(self):
+        self.preview_worker.set_source(None, False)
+
         if self.video_helper:
             if self.input_device_id == self.video_helper.input_cam.device_id:
                 self.input_cam = self.video_helper.input_cam
@@ -209,11 +494,15 @@ class VideoUi:
             self.video_helper = None
             self.status_bar.showMessage('Ending video feed')
         else:
+            # the preview camera may still be opening, it has to be closed before video takes the device
+            self.camera_opener.wait()
+            self.camera_opened()
             try:
                 if self.input_cam and self.input_device_id == self.input_cam.device_id:
                     self.input_cam.release()
                     self.input_cam = None
 
+                metrics.reset()
                 self.video_helper = VideoHelper(self.input_device_id, None, self)
 
                 logging.info('Input camera: ' + self.video_helper.input_cam.device_id)
@@ -221,24 +510,81 @@ class VideoUi:
 
                 self.input_cam = self.video_helper.input_cam
                 self.status_bar.showMessage('Starting video feed')
+                self.apply_clip()
             except ValueError:
                 logging.error('Cannot find cameras')
                 self.status_bar.showMessage('Error: Cannot find cameras')
             except SystemError:
                 logging.error('Cannot allocate selected camera')
                 self.status_bar.showMessage('Error: Cannot allocate selected camera')
+            except OSError as e:
+                logging.error('Cannot start video: %s' % e)
+                self.status_bar.showMessage('Error: %s' % e)
 
+        self.update_preview_source()
         self.video_source.setEnabled(not self.video_helper)
         self.video_button.setText("Start video" if self.video_helper is None else "Stop video")
         self.video_button.setChecked(self.video_helper is not None)
 
+    def update_clip_list(self):
+        self.clip_source.clear()
+        self.clip_source.addItem('Live buffer')
+        self.clip_source.addItems(self.clip_library.list_clips())
+        if self.clip_name is not None:
+            self.clip_source.setCurrentIndex(max(0, self.clip_source.findText(self.clip_name)))
+
+    def select_clip(self, index):
+        self.clip_name = None if index <= 0 else self.clip_source.itemText(index)
+        self.set_looping(False)
+        self.apply_clip()
+
+    def apply_clip(self):
+        if self.video_helper is None:
+            return
+
+        try:
+            if self.clip_name is None:
+                self.video_helper.set_clip(None)
+            else:
+                frames, info = self.clip_library.load(self.clip_name)
+                self.video_helper.set_clip(frames, info['layout'])
+                self.status_bar.showMessage('Selected clip %s' % self.clip_name)
+        except (OSError, ValueError) as e:
+            logging.error('Cannot load clip %r: %s' % (self.clip_name, e))
+            self.status_bar.showMessage('Error: Cannot load clip')
+            self.clip_name = None
+            self.clip_source.setCurrentIndex(0)
+            self.video_helper.set_clip(None)
+
+    def save_clip(self):
+        if self.video_helper is None:
+            self.status_bar.showMessage('Error: Start video before saving a clip')
+            return
+
+        name, ok = QtWidgets.QInputDialog.getText(self.window, 'Save Clip', 'Clip name:')
+        if not ok:
+            return
+
+        try:
+            self.video_helper.save_clip(self.clip_library, name)
+            self.status_bar.showMessage('Saved clip %s' % name.strip())
+        except ValueError as e:
+            self.status_bar.showMessage('Error: %s' % e)
+        except OSError as e:
+            logging.error('Cannot save clip: %s' % e)
+            self.status_bar.showMessage('Error: Cannot save clip')
+        self.update_clip_list()
+
     def set_capture(self, value: bool):
         self.audio.set_capture(value)
         self.speak_button.setChecked(value)
 
+    def capture_changed(self, value: bool):
+        # also called for changes made outside mmhZoom, e.g. in alsamixer
+        self.speak_button.setChecked(value)
+
     def toggle_speak(self):
-        #is_capturing = not self.audio.is_capturing()
-        is_capturing = not self.audio.should_capture
+        is_capturing = not self.audio.is_capturing()
         self.set_capture(is_capturing)
 
         if is_capturing:
@@ -277,50 +623,11 @@ class VideoUi:
         self.set_looping(is_looping)
 
 
-    def render_preview_frame(self):
-        if self.input_cam is None:
-            widget = self.preview
-            #widget.setGeometry(50,200,500,500)
-            #renderer =  QtSvg.QSvgRenderer('./assets/no-video.svg')
-            #widget.resize(renderer.defaultSize())
-            #painter = QPainter(widget)
-            #painter.restore()
-            #renderer.render(painter)
-            #widget.show()
+    def update_metrics(self):
+        self.metrics_label.setText(metrics.summary() if self.video_helper else '')
 
-            image = QImage(100, 100, QImage.Format_RGB888)
-            image.fill(0)
-            pix = QPixmap(image)
-            self.preview.setPixmap(pix)
+    def update_preview_source(self):
+        self.preview_worker.set_source(self.input_cam, self.video_helper is not None)
 
-            # https://wiki.qt.io/How_to_Change_the_Background_Color_of_QWidget
-
-            # No border
-            #pal = QPalette()
-            #pal.setColor(QPalette.Background, QtGui.QColor(0, 0, 0, 0))
-            #self.video_button.setPalette(pal)
-            return
-
-        if self.video_helper:
-            data = self.input_cam.read_recent_frame() # ugly hack
-        else:
-            data = self.input_cam.read()
-
-        if data is None:
-            return
-
-        # Red border
-        #pal = QPalette()
-        #pal.setColor(QPalette.Background, QtGui.QColor(255, 0, 0))
-        #self.video_button.setPalette(pal)
-
-        # https://pythonbasics.org/pyqt-qpixmap/
-        # https://stackoverflow.com/questions/45018926/how-to-properly-setpixmap-scaled-on-pyqt5#45019730
-        # https://stackoverflow.com/questions/40391901/getting-webcam-footage-from-opencv-to-pyqt/42844998
-        data = data[::2, ::2, :] # downscale
-        data = data.transpose((1,0,2)).copy() # bad for performance
-        height, width, channels = data.shape
-        bpl = 3 * width 
-        image = QImage(data, width, height, bpl, QImage.Format_RGB888)
-        pix = QPixmap(image)
-        self.preview.setPixmap(pix)
+    def show_preview_frame(self, image: QImage):
+        self.preview.setPixmap(QPixmap.fromImage(image))